@@ -1,11 +1,9 @@
 import os
 import time
-import subprocess
 import shutil
 import sys
 import logging
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
 
 import json
 from rich.progress import (
@@ -14,9 +12,14 @@ from rich.progress import (
     SpinnerColumn,
     TimeElapsedColumn,
 )
+from rich.console import Console
+from rich.table import Table
 import cv2
 
 from .command import BaseCommand
+from ...packages.keyframes import get_selector_cls
+from ...packages.keyframes.scheduler import IngestScheduler, open_video
+from ...packages.manifest import Manifest, fingerprint
 from ...config import GlobalConfig
 
 
@@ -58,6 +61,14 @@ class AddCommand(BaseCommand):
             action="store_true",
             help="Overwrite existing files",
         )
+        parser.add_argument(
+            "-s",
+            "--selector",
+            dest="selector_name",
+            type=str,
+            default=GlobalConfig.get("add", "keyframe_selector") or "codec",
+            help="Keyframe selector (codec or shot)",
+        )
 
         parser.set_defaults(func=self)
 
@@ -67,6 +78,7 @@ class AddCommand(BaseCommand):
         do_multi,
         do_move,
         do_overwrite,
+        selector_name,
         verbose,
         *args,
         **kwargs,
@@ -88,136 +100,161 @@ class AddCommand(BaseCommand):
                 sys.exit(1)
             video_paths = [video_path]
         video_paths = sorted(video_paths, key=lambda path: path.stem)
-        self._add_videos(video_paths, do_move, do_overwrite, verbose)
+        manifest = Manifest(self._work_dir)
+        try:
+            self._add_videos(
+                manifest,
+                video_paths,
+                do_move,
+                do_overwrite,
+                selector_name,
+                verbose,
+            )
+        finally:
+            manifest.close()
 
-    def _add_videos(self, video_paths, do_move, do_overwrite, verbose):
+    def _add_videos(
+        self,
+        manifest,
+        video_paths,
+        do_move,
+        do_overwrite,
+        selector_name,
+        verbose,
+    ):
         max_workers_ratio = GlobalConfig.get("max_workers_ratio") or 0
-        with (
-            Progress(
-                TextColumn("{task.fields[name]}"),
-                TextColumn(":"),
-                SpinnerColumn(),
-                *Progress.get_default_columns(),
-                TimeElapsedColumn(),
-                disable=not verbose,
-            ) as progress,
-            ThreadPoolExecutor(
-                round((os.cpu_count() or 0) * max_workers_ratio) or 1
-            ) as executor,
-        ):
+        max_workers = round((os.cpu_count() or 0) * max_workers_ratio) or 1
+        workers = GlobalConfig.get("add", "workers") or {}
+        scheduler = IngestScheduler(
+            prepare_workers=workers.get("prepare") or 2,
+            decode_workers=workers.get("decode") or max_workers,
+            write_workers=workers.get("write") or max(1, max_workers // 2),
+            queue_size=workers.get("queue_size") or 4,
+            frame_queue_size=workers.get("frame_queue_size") or 64,
+            hw_decode=GlobalConfig.get("add", "hw_decode") or False,
+        )
+        with Progress(
+            TextColumn("{task.fields[name]}"),
+            TextColumn(":"),
+            SpinnerColumn(),
+            TextColumn("{task.description}"),
+            TextColumn("{task.completed} frames"),
+            TimeElapsedColumn(),
+            disable=not verbose,
+        ) as progress:
+            task_ids = {}
 
-            def show_progress(task_id):
-                return lambda **kwargs: progress.update(task_id, **kwargs)
-
-            def add_one_video(video_path):
-                task_id = progress.add_task(
-                    total=2,
-                    description=f"Processing...",
-                    name=video_path.name,
-                )
-                try:
-                    output_path, video_id = self._load_video(
-                        video_path,
-                        do_move,
-                        do_overwrite,
-                        show_progress(task_id),
-                    )
-                    progress.advance(task_id)
-                    if video_id:
-                        self._extract_keyframes(
-                            output_path,
-                            show_progress(task_id),
-                        )
-                        progress.advance(task_id)
-
-                    progress.update(
-                        task_id,
-                        completed=1,
-                        total=1,
-                        description=(
-                            f"Added with ID {video_id}"
-                            if video_id
-                            else f"Skipped"
-                        ),
+            def on_event(kind, video_id, value):
+                if kind == "done":
+                    self._record_keyframes(manifest, video_id, value)
+                task_id = task_ids.get(video_id)
+                if kind == "prepared" and value:
+                    task_ids[video_id] = progress.add_task(
+                        description="Extracting keyframes...",
+                        name=video_id,
+                        total=None,
                     )
+                elif task_id is None:
+                    return
+                elif kind == "decoded":
+                    progress.advance(task_id, value)
+                elif kind == "error":
+                    progress.update(task_id, description=f"Error: {value}")
+                elif kind == "done" and value:
                     progress.remove_task(task_id)
-                except Exception as e:
-                    progress.update(
-                        task_id,
-                        description=f"Error: {str(e)}",
-                    )
 
-            for path in video_paths:
-                executor.submit(add_one_video, path)
+            success = scheduler.run(
+                video_paths,
+                lambda path: self._prepare_video(
+                    manifest, path, do_move, do_overwrite, selector_name
+                ),
+                on_event,
+            )
+
+        if verbose:
+            self._print_stats(scheduler)
+        for video_id, error in scheduler.errors.items():
+            self._logger.error(f"{video_id}: {error}")
+        if not success:
+            sys.exit(1)
 
-    def _load_video(self, video_path, do_move, do_overwrite, update_progress):
-        update_progress(description=f"Loading...")
+    def _print_stats(self, scheduler):
+        table = Table(title="Ingest throughput")
+        for column in ["stage", "count", "seconds", "per second", "MiB"]:
+            table.add_column(column, justify="right")
+        for stage in scheduler.stages.values():
+            table.add_row(
+                stage.name,
+                f"{stage.count} {stage.unit}",
+                f"{stage.elapsed:.1f}",
+                f"{stage.throughput:.1f}",
+                f"{stage.bytes / 1024 / 1024:.1f}" if stage.bytes else "-",
+            )
+        Console().print(table)
+
+    def _prepare_video(
+        self, manifest, video_path, do_move, do_overwrite, selector_name
+    ):
         video_id = video_path.stem
         output_path = (
             self._work_dir / "videos" / f"{video_id}{video_path.suffix}"
         )
+        keyframe_dir = self._work_dir / "keyframes" / f"{video_id}"
 
-        if output_path.exists() and not do_overwrite:
-            return output_path, None
-
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        if do_move:
-            shutil.move(video_path, output_path)
-        else:
-            shutil.copy(video_path, output_path)
-
-        return output_path, video_id
+        # Unchanged videos whose keyframes were all written are skipped; a
+        # crash leaves the stage running, so the video is extracted again
+        source_fingerprint = fingerprint(video_path)
+        manifest.adopt(self._work_dir, video_id)
+        if not do_overwrite and manifest.is_done(
+            video_id, "keyframes", source_fingerprint
+        ):
+            return video_id, None, None, None, None
 
-    def _extract_keyframes(self, video_path, update_progress):
-        update_progress(description=f"Extracting keyframes...")
+        self._load_video(video_path, output_path, source_fingerprint, do_move)
+        manifest.start_stage(video_id, "keyframes", source_fingerprint)
 
-        keyframe_dir = self._work_dir / "keyframes" / f"{video_path.stem}"
         if keyframe_dir.exists():
             shutil.rmtree(keyframe_dir)
-
         keyframe_dir.mkdir(parents=True, exist_ok=True)
-        keyframes_list = self._get_keyframes_list(video_path)
-        max_scene_length = GlobalConfig.get("add", "max_scene_length") or 25
-
-        update_progress(description=f"Saving keyframes...")
-
-        frame_counter = 0
-        scene_length = 0
-        cap = cv2.VideoCapture(str(video_path))
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            if (
-                scene_length >= max_scene_length
-                or frame_counter in keyframes_list
-            ):
-                cv2.imwrite(
-                    keyframe_dir / f"{frame_counter:06d}.jpg",
-                    frame,
-                    [cv2.IMWRITE_JPEG_QUALITY, 50],
-                )
-                scene_length = 0
-            scene_length += 1
-            frame_counter += 1
+
+        selector = self._create_selector(selector_name)
+        cap = open_video(output_path)
+        num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         cap.release()
+        last_frame = selector.start(output_path, num_frames)
+        return video_id, output_path, keyframe_dir, selector, last_frame
 
-    def _get_keyframes_list(self, video_path):
-        ffprobe_cmd = (
-            ["ffprobe", "-v", "quiet"]
-            + [
-                "-select_streams",
-                "v",
-                "-show_frames",
-                "-show_entries",
-                "frame=pict_type",
-            ]
-            + ["-of", "csv", str(video_path)]
+    def _load_video(self, video_path, output_path, source_fingerprint, do_move):
+        if output_path.exists() and fingerprint(output_path) == (
+            source_fingerprint
+        ):
+            return
+
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        if do_move:
+            shutil.move(video_path, output_path)
+        else:
+            shutil.copy(video_path, output_path)
+
+    def _record_keyframes(self, manifest, video_id, success):
+        stage = manifest.get_stage(video_id, "keyframes")
+        if stage is None:
+            return
+        if not success:
+            manifest.fail_stage(video_id, "keyframes")
+            return
+        keyframe_dir = self._work_dir / "keyframes" / video_id
+        manifest.set_frames(
+            video_id,
+            stage["input_hash"],
+            [x.stem for x in keyframe_dir.glob("*.jpg")],
         )
-        res = subprocess.run(ffprobe_cmd, capture_output=True, text=True)
-        keyframes_list = res.stdout.strip().split("\n")
-        keyframes_list = [x for x in keyframes_list if x.startswith("frame")]
-        keyframes_list = [
-            i for i, x in enumerate(keyframes_list) if x.startswith("frame,I")
-        ]
-        return keyframes_list
+
+    def _create_selector(self, selector_name):
+        kwargs = dict(GlobalConfig.get("add", selector_name) or {})
+        if selector_name == "codec":
+            kwargs.setdefault(
+                "max_scene_length",
+                GlobalConfig.get("add", "max_scene_length") or 25,
+            )
+        return get_selector_cls(selector_name)(**kwargs)
@@ -1,15 +1,20 @@
 import os
 import json
+import queue
+import hashlib
 from pathlib import Path
 import shutil
 from concurrent.futures import ThreadPoolExecutor
 
-import numpy as np
 import torch
 from rich.progress import Progress, SpinnerColumn, TimeElapsedColumn, TextColumn
 
 from .command import BaseCommand
-from ...packages.analyse.features import CLIP, TrOCR
+from ...packages.analyse.features import create_extractor
+from ...packages.analyse.pool import InferencePool
+from ...packages.analyse.router import FeatureRouter, VideoJob
+from ...packages.manifest import Manifest, combine_hashes
+from ...packages.store import FeatureStore
 from ...config import GlobalConfig
 
 
@@ -35,181 +40,240 @@ class AnalyseCommand(BaseCommand):
             action="store_true",
             help="Skip overlapping videos",
         )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            dest="workers",
+            type=int,
+            default=None,
+            help="Number of CPU inference processes, each with its own model",
+        )
+        parser.add_argument(
+            "-t",
+            "--threads-per-worker",
+            dest="threads_per_worker",
+            type=int,
+            default=None,
+            help="Intra-op threads of each CPU inference process",
+        )
 
         parser.set_defaults(func=self)
 
-    def __call__(self, gpu, do_overwrite, verbose, *args, **kwargs):
+    def __call__(
+        self,
+        gpu,
+        do_overwrite,
+        workers,
+        threads_per_worker,
+        verbose,
+        *args,
+        **kwargs,
+    ):
         models = GlobalConfig.get("analyse", "features")
-        max_workers_ratio = GlobalConfig.get("max_workers_ratio") or 0
         if models is None:
             raise RuntimeError(
                 f"Models for features extraction are not specified. Check your config file."
             )
-        video_ids = self._get_video_ids()
+        manifest = Manifest(self._work_dir)
+        store = FeatureStore(self._work_dir / "features")
+        video_ids = manifest.scan(self._work_dir)
+
+        device = self._get_device(gpu)
+        if workers is None:
+            workers = GlobalConfig.get("analyse", "workers") or 1
+        if threads_per_worker is None:
+            threads_per_worker = GlobalConfig.get(
+                "analyse", "threads_per_worker"
+            ) or max(1, (os.cpu_count() or 1) // workers)
 
         for model_info in models:
             model_name = model_info["name"].lower()
             batch_size = model_info["batch_size"]
-            if model_name == "clip":
-                pretrained_model = model_info["pretrained_model"]
-                model = CLIP(pretrained_model)
-                self._logger.info(
-                    f"Start extracting features using {model_name} ({pretrained_model})"
-                )
-            elif model_name == "ocr":
-                model = TrOCR()
-                self._logger.info(
-                    f"Start extracting features using {model_name} (easyOCR)"
-                )
-            else:
+            if model_name not in ["clip", "ocr"]:
                 self._logger.error(f"{model_name}: model is not available")
                 continue
 
-            if gpu and torch.cuda.is_available():
-                max_workers = 1
-                model.to("cuda")
-            elif gpu and torch.backends.mps.is_available():
-                max_workers = 1
-                model.to("mps")
+            stage = f"features:{model_name}"
+            jobs = []
+            for video_id in video_ids:
+                job = self._plan_video(
+                    manifest, model_name, video_id, do_overwrite
+                )
+                if job is not None:
+                    jobs.append(job)
+            if len(jobs) == 0:
+                self._logger.info(f"{model_name}: no keyframes left to analyse")
+                continue
+
+            source = model_info.get("pretrained_model") or "easyOCR"
+            if device == "cpu" and workers > 1:
+                # Each worker process loads its own model
+                model = InferencePool(
+                    model_info,
+                    workers,
+                    threads_per_worker,
+                    GlobalConfig.get("analyse", "shard_batches") or 4,
+                )
+                self._logger.info(
+                    f"Start extracting features using {model_name} ({source}) "
+                    f"on {workers} workers x {threads_per_worker} threads"
+                )
             else:
-                max_workers = round((os.cpu_count() or 0) * max_workers_ratio)
-                if max_workers <= 0:
-                    max_workers = 1
+                model = create_extractor(model_info)
+                model.to(device)
+                if device == "cpu":
+                    torch.set_num_threads(threads_per_worker)
+                self._logger.info(
+                    f"Start extracting features using {model_name} ({source})"
+                )
 
-                model.to("cpu")
-                self._logger.warning(
-                    "CUDA is not available, fallbacked to use CPU"
+            with Progress(
+                TextColumn("{task.fields[name]}"),
+                TextColumn(":"),
+                SpinnerColumn(),
+                *Progress.get_default_columns(),
+                TimeElapsedColumn(),
+                disable=not verbose,
+            ) as progress:
+                task_id = progress.add_task(
+                    description=f"Extracting features of {len(jobs)} videos...",
+                    name=model_name,
+                    total=sum([len(x) for x in jobs]),
                 )
 
-            with (
-                Progress(
-                    TextColumn("{task.fields[name]}"),
-                    TextColumn(":"),
-                    SpinnerColumn(),
-                    *Progress.get_default_columns(),
-                    TimeElapsedColumn(),
-                    disable=not verbose,
-                ) as progress,
-                ThreadPoolExecutor(max_workers) as executor,
-            ):
-
-                def update_progress(task_id):
-                    return lambda *args, **kwargs: progress.update(
-                        task_id, *args, **kwargs
+                def on_done(job):
+                    manifest.mark_frames(job.video_id, stage, job.frame_ids)
+                    manifest.finish_stage(
+                        job.video_id,
+                        stage,
+                        job.input_hash,
+                        job.digest.hexdigest(),
                     )
 
-                def analyse_one_video(video_id):
-                    task_id = progress.add_task(
-                        description="Processing...",
-                        name=video_id,
+                router = FeatureRouter(store, model_name, jobs, on_done)
+                try:
+                    self._extract_features(
+                        model,
+                        router,
+                        [x for job in jobs for x in job.paths],
+                        batch_size,
+                        lambda count: progress.advance(task_id, count),
                     )
-                    try:
-                        status_ok = self._extract_features(
-                            model_name,
-                            model,
-                            video_id,
-                            batch_size,
-                            do_overwrite,
-                            update_progress(task_id),
-                        )
-                        progress.update(
-                            task_id,
-                            completed=1,
-                            total=1,
-                            description=(
-                                "Finished" if status_ok else "Skipped"
-                            ),
-                        )
-                        progress.remove_task(task_id)
-                    except Exception as e:
-                        progress.update(task_id, description=f"Error: {str(e)}")
-
-                futures = []
-                for video_id in video_ids:
-                    futures.append(executor.submit(analyse_one_video, video_id))
-                for future in futures:
-                    future.result()
-
-    def _get_video_ids(self):
-        keyframes_dir = self._work_dir / "keyframes"
-        video_ids = sorted(
-            [d.stem for d in keyframes_dir.glob("*") if d.is_dir()]
-        )
-        return video_ids
+                    progress.update(task_id, description="Finished")
+                except Exception as e:
+                    progress.update(task_id, description=f"Error: {str(e)}")
+                    for job in router.pending():
+                        manifest.fail_stage(job.video_id, stage)
+                    router.abort()
+                finally:
+                    if isinstance(model, InferencePool):
+                        model.shutdown()
+        manifest.close()
 
-    def _get_keyframes_list(self, model_name, video_id, do_overwrite):
+    def _get_device(self, gpu):
+        if gpu and torch.cuda.is_available():
+            return "cuda"
+        if gpu and torch.backends.mps.is_available():
+            return "mps"
+        self._logger.warning("CUDA is not available, fallbacked to use CPU")
+        return "cpu"
+
+    def _get_keyframes_list(self, manifest, model_name, video_id, do_overwrite):
         keyframes_dir = self._work_dir / "keyframes" / video_id
-        features_dir = self._work_dir / "features" / video_id
+        stage = f"features:{model_name}"
 
         has_features = set()
-        if features_dir.exists() and not do_overwrite:
-            for keyframe in features_dir.glob("*"):
-                if not keyframe.is_dir():
-                    continue
-                for feature in keyframe.glob("*"):
-                    if feature.is_dir():
-                        continue
-                    if feature.stem == model_name:
-                        has_features.add(keyframe.stem)
-                        break
-
-        keyframes = []
-        for keyframe in keyframes_dir.glob("*"):
-            if (
-                keyframe.is_dir()
-                or keyframe.stem[0] == "."
-                or keyframe.stem in has_features
-            ):
-                continue
-            keyframes.append(keyframe)
+        if not do_overwrite:
+            has_features = manifest.get_done_frames(video_id, stage)
 
-        return keyframes
+        return [
+            keyframes_dir / f"{x}.jpg"
+            for x in manifest.get_frames(video_id)
+            if x not in has_features
+        ]
 
-    def _extract_features(
-        self,
-        model_name,
-        model,
-        video_id,
-        batch_size,
-        do_overwrite,
-        update_progress,
-    ):
-        update_progress(description="Extracting features...")
+    def _plan_video(self, manifest, model_name, video_id, do_overwrite):
+        stage = f"features:{model_name}"
+        keyframes_hash = manifest.get_stage(video_id, "keyframes")[
+            "output_hash"
+        ]
+        previous = manifest.get_stage(video_id, stage)
+        previous_hash = (
+            previous["output_hash"]
+            if previous is not None and not do_overwrite
+            else None
+        )
         keyframe_files = self._get_keyframes_list(
-            model_name, video_id, do_overwrite
+            manifest, model_name, video_id, do_overwrite
         )
         if len(keyframe_files) == 0:
-            return 1
-        features_dir = self._work_dir / f"features" / video_id
+            if previous_hash is None or previous["status"] != "done":
+                manifest.finish_stage(
+                    video_id,
+                    stage,
+                    keyframes_hash,
+                    previous_hash or combine_hashes(keyframes_hash),
+                )
+            return None
+        manifest.start_stage(video_id, stage, keyframes_hash)
 
-        features = model.get_image_features(
+        frame_ids = [path.stem for path in keyframe_files]
+        # The output hash changes whenever features of the video change, which
+        # is what index compares to find videos to index again
+        digest = hashlib.blake2b(
+            (previous_hash or keyframes_hash).encode("utf-8"), digest_size=16
+        )
+        digest.update(json.dumps(frame_ids).encode("utf-8"))
+        return VideoJob(
+            video_id,
+            frame_ids,
             keyframe_files,
-            batch_size,
-            lambda finished_batches, total_batches, _: update_progress(
-                completed=finished_batches, total=total_batches
-            ),
+            # Frames analysed earlier stay in the shard unless all are redone
+            len(frame_ids) < len(manifest.get_frames(video_id)),
+            digest,
+            keyframes_hash,
         )
-        if model_name == "clip":
-            features = features.cpu()
 
-        update_progress(
-            completed=0,
-            total=len(keyframe_files),
-            description="Saving features...",
+    def _extract_features(
+        self, model, router, keyframe_files, batch_size, advance
+    ):
+        # Keyframes of all videos are batched together, so batches stay full
+        # across video boundaries. Inference runs here while a writer thread
+        # copies finished batches off the device and routes them to their
+        # videos; the queue bounds how many batches are in flight.
+        batches = queue.Queue(
+            GlobalConfig.get("analyse", "prefetch_batches") or 2
         )
-        for i, path in enumerate(keyframe_files):
-            save_dir = features_dir / path.stem
-            save_dir.mkdir(parents=True, exist_ok=True)
-            if isinstance(features[i], torch.Tensor) or isinstance(
-                features[i], np.ndarray
-            ):
-                np.save(save_dir / f"{model_name}.npy", features[i])
-            elif isinstance(features[i], str):
-                with open(save_dir / f"{model_name}.txt", "w") as f:
-                    f.write(features[i])
-            else:
-                with open(save_dir / f"{model_name}.json", "w") as f:
-                    json.dump(features[i], f)
-            update_progress(advance=1)
+        with ThreadPoolExecutor(1) as executor:
+            writer = executor.submit(
+                self._write_batches, router, batches, advance
+            )
+            try:
+                for batch_features in model.iter_image_features(
+                    keyframe_files, batch_size
+                ):
+                    batches.put(batch_features)
+            finally:
+                batches.put(None)
+                writer.result()
+
+    def _write_batches(self, router, batches, advance):
+        # After an error the queue is still drained, so the producer never
+        # blocks
+        error = None
+        while True:
+            batch_features = batches.get()
+            if batch_features is None:
+                break
+            if error is not None:
+                continue
+            try:
+                if isinstance(batch_features, torch.Tensor):
+                    batch_features = batch_features.cpu().numpy()
+                router.route(batch_features)
+                advance(len(batch_features))
+            except Exception as e:
+                error = e
 
-        return 1
+        if error is not None:
+            raise error
@@ -0,0 +1,222 @@
+import time
+
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+from .command import BaseCommand
+from ...config import GlobalConfig
+from ...packages.index import get_database_cls
+from ...packages.index.flat import FlatIndex
+from ...packages.index.ivf import IVFIndex, normalize
+from ...packages.analyse.features import TextEncoder
+from ...packages.store import FeatureStore
+
+
+class BenchmarkCommand(BaseCommand):
+    def __init__(self, *args, **kwargs):
+        super(BenchmarkCommand, self).__init__(*args, **kwargs)
+
+    def add_args(self, subparser):
+        parser = subparser.add_parser(
+            "benchmark",
+            help="Measure recall and latency of the vector index against exact search",
+        )
+        parser.add_argument(
+            "-c",
+            "--collection",
+            dest="collection_name",
+            type=str,
+            default="milvus",
+            help="Name of collection to benchmark",
+        )
+        parser.add_argument(
+            "-b",
+            "--backend",
+            dest="backend",
+            type=str,
+            default=GlobalConfig.get("webui", "database") or "milvus",
+            help="Database backend to benchmark (milvus or local)",
+        )
+        parser.add_argument(
+            "-m",
+            "--model",
+            dest="model",
+            type=str,
+            default="clip",
+            help="Vector field to benchmark",
+        )
+        parser.add_argument(
+            "-k",
+            "--top-k",
+            dest="top_k",
+            type=int,
+            nargs="+",
+            default=[10, 100],
+            help="Values of k to report recall@k for",
+        )
+        parser.add_argument(
+            "--nprobe",
+            dest="nprobe",
+            type=int,
+            nargs="+",
+            default=[1, 2, 4, 8, 16, 32, 64, 128],
+            help="nprobe values to sweep",
+        )
+        parser.add_argument(
+            "--nlist",
+            dest="nlist",
+            type=int,
+            nargs="*",
+            default=[],
+            help="Also train in-memory IVF indices with these nlist values",
+        )
+        parser.add_argument(
+            "-n",
+            "--num-queries",
+            dest="num_queries",
+            type=int,
+            default=100,
+            help="Number of stored vectors sampled as queries",
+        )
+        parser.add_argument(
+            "-t",
+            "--text",
+            dest="text_file",
+            type=str,
+            default=None,
+            help="File with one text query per line, used instead of sampled vectors",
+        )
+
+        parser.set_defaults(func=self)
+
+    def __call__(
+        self,
+        collection_name,
+        backend,
+        model,
+        top_k,
+        nprobe,
+        nlist,
+        num_queries,
+        text_file,
+        verbose,
+        *args,
+        **kwargs,
+    ):
+        frame_ids, vectors = self._load_vectors(model)
+        if len(frame_ids) == 0:
+            self._logger.error(f"No {model} features found")
+            return
+        queries = self._get_queries(vectors, model, num_queries, text_file)
+        max_k = max(top_k)
+        self._logger.info(
+            f"Benchmarking {len(queries)} queries over {len(frame_ids)} vectors"
+        )
+
+        flat = FlatIndex(vectors)
+        truth, latencies = [], []
+        for query in queries:
+            st = time.perf_counter()
+            rows, _ = flat.search([query], max_k)
+            latencies.append(time.perf_counter() - st)
+            truth.append(rows[0])
+        reports = [("exact", "-", "-", truth, latencies)]
+
+        database_cls = get_database_cls(backend)
+        database_cls.start_server()
+        database = database_cls(collection_name, work_dir=self._work_dir)
+        positions = {id: i for i, id in enumerate(frame_ids)}
+        for p in nprobe:
+            found, latencies = [], []
+            for query in queries:
+                st = time.perf_counter()
+                res = database.search(
+                    [query.tolist()], "", 0, max_k, p, model, ["frame_id"]
+                )[0]
+                latencies.append(time.perf_counter() - st)
+                found.append([positions.get(x["id"], -1) for x in res])
+            reports.append(
+                (backend, database.get_nlist(model), p, found, latencies)
+            )
+
+        for nl in nlist:
+            self._logger.info(f"Training in-memory IVF index (nlist={nl})")
+            index = IVFIndex.train(vectors, nl)
+            for p in nprobe:
+                if p > nl:
+                    continue
+                found, latencies = [], []
+                for query in queries:
+                    st = time.perf_counter()
+                    rows, _ = flat.search(
+                        [query], max_k, index.candidates(query, p)
+                    )
+                    latencies.append(time.perf_counter() - st)
+                    found.append(rows[0])
+                reports.append(("ivf", nl, p, found, latencies))
+
+        self._print_report(reports, truth, top_k)
+
+    def _load_vectors(self, model):
+        store = FeatureStore(self._work_dir / "features")
+        frame_ids = []
+        vectors = []
+        for video_id in store.video_ids():
+            if not store.has(video_id, model):
+                continue
+            ids, values = store.read(video_id, model)
+            frame_ids.extend([f"{video_id}#{x}" for x in ids])
+            vectors.append(values)
+        if len(vectors) == 0:
+            return frame_ids, None
+        return frame_ids, normalize(np.concatenate(vectors))
+
+    def _get_queries(self, vectors, model, num_queries, text_file):
+        if text_file is None:
+            rng = np.random.default_rng(0)
+            sample = rng.choice(
+                len(vectors), min(num_queries, len(vectors)), replace=False
+            )
+            return vectors[sample]
+
+        pretrained_model = next(
+            x["pretrained_model"]
+            for x in GlobalConfig.get("webui", "features") or []
+            if x["name"].lower() == model
+        )
+        with open(text_file, "r") as f:
+            texts = [x.strip() for x in f if len(x.strip()) > 0]
+        text_features = TextEncoder(pretrained_model).get_text_features(texts)
+        return normalize(text_features.cpu().numpy())
+
+    def _print_report(self, reports, truth, top_k):
+        table = Table(title="Vector search benchmark")
+        for column in ["index", "nlist", "nprobe"]:
+            table.add_column(column)
+        for k in top_k:
+            table.add_column(f"recall@{k}", justify="right")
+        for column in ["p50 ms", "p95 ms"]:
+            table.add_column(column, justify="right")
+
+        for name, nlist, nprobe, found, latencies in reports:
+            recalls = []
+            for k in top_k:
+                recall = np.mean(
+                    [
+                        len(set(x[:k]) & set(y[:k])) / min(k, len(y))
+                        for x, y in zip(found, truth)
+                    ]
+                )
+                recalls.append(f"{recall:.4f}")
+            latencies = np.array(latencies) * 1000
+            table.add_row(
+                name,
+                str(nlist),
+                str(nprobe),
+                *recalls,
+                f"{np.percentile(latencies, 50):.2f}",
+                f"{np.percentile(latencies, 95):.2f}",
+            )
+
+        Console().print(table)
@@ -0,0 +1,100 @@
+import os
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from rich.progress import Progress, SpinnerColumn, TextColumn, TimeElapsedColumn
+
+from .command import BaseCommand
+from ...packages.store import FeatureStore
+from ...config import GlobalConfig
+
+
+class ConvertCommand(BaseCommand):
+    def __init__(self, *args, **kwargs):
+        super(ConvertCommand, self).__init__(*args, **kwargs)
+
+    def add_args(self, subparser):
+        parser = subparser.add_parser(
+            "convert",
+            help="Pack per-keyframe feature files into per-video shards",
+        )
+        parser.add_argument(
+            "-k",
+            "--keep",
+            dest="do_keep",
+            action="store_true",
+            help="Keep the per-keyframe files after packing them",
+        )
+
+        parser.set_defaults(func=self)
+
+    def __call__(self, do_keep, verbose, *args, **kwargs):
+        features_dir = self._work_dir / "features"
+        store = FeatureStore(features_dir)
+        max_workers_ratio = GlobalConfig.get("max_workers_ratio") or 0
+        with (
+            Progress(
+                TextColumn("{task.fields[name]}"),
+                TextColumn(":"),
+                SpinnerColumn(),
+                *Progress.get_default_columns(),
+                TimeElapsedColumn(),
+                disable=not verbose,
+            ) as progress,
+            ThreadPoolExecutor(
+                round((os.cpu_count() or 0) * max_workers_ratio) or 1
+            ) as executor,
+        ):
+
+            def convert_one_video(video_id):
+                task_id = progress.add_task(
+                    description="Packing...", name=video_id
+                )
+                try:
+                    self._convert_video(store, features_dir, video_id, do_keep)
+                    progress.remove_task(task_id)
+                except Exception as e:
+                    progress.update(task_id, description=f"Error: {str(e)}")
+
+            futures = []
+            for video_id in store.video_ids():
+                futures.append(executor.submit(convert_one_video, video_id))
+            for future in futures:
+                future.result()
+
+    def _convert_video(self, store, features_dir, video_id, do_keep):
+        frame_dirs = sorted(
+            [d for d in (features_dir / video_id).glob("*") if d.is_dir()]
+        )
+        if len(frame_dirs) == 0:
+            return
+
+        features = {}
+        for frame_dir in frame_dirs:
+            for feature_path in frame_dir.glob("*"):
+                if feature_path.suffix == ".npy":
+                    feature = np.load(feature_path)
+                elif feature_path.suffix == ".txt":
+                    with open(feature_path, "r") as f:
+                        feature = f.read()
+                elif feature_path.suffix == ".json":
+                    with open(feature_path, "r") as f:
+                        feature = json.load(f)
+                else:
+                    continue
+                frame_ids, values = features.setdefault(
+                    feature_path.stem, ([], [])
+                )
+                frame_ids.append(frame_dir.name)
+                values.append(feature)
+
+        for model, (frame_ids, values) in features.items():
+            if isinstance(values[0], np.ndarray):
+                values = np.stack(values)
+            store.write(video_id, model, frame_ids, values)
+
+        if not do_keep:
+            for frame_dir in frame_dirs:
+                shutil.rmtree(frame_dir)
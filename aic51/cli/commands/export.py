@@ -0,0 +1,222 @@
+import time
+
+import numpy as np
+import torch
+from rich.console import Console
+from rich.table import Table
+from transformers import CLIPModel, CLIPProcessor
+
+from .command import BaseCommand
+from ...config import GlobalConfig
+from ...packages.analyse.features.towers import (
+    EagerTowers,
+    export_path,
+    export_towers,
+    load_towers,
+)
+
+
+class ExportCommand(BaseCommand):
+    def __init__(self, *args, **kwargs):
+        super(ExportCommand, self).__init__(*args, **kwargs)
+
+    def add_args(self, subparser):
+        clip_models = [
+            x["pretrained_model"]
+            for x in GlobalConfig.get("analyse", "features") or []
+            if x["name"].lower() == "clip"
+        ]
+        parser = subparser.add_parser(
+            "export",
+            help="Export the CLIP encoders to ONNX or TorchScript for CPU inference",
+        )
+        parser.add_argument(
+            "-m",
+            "--model",
+            dest="pretrained_model",
+            type=str,
+            default=clip_models[0] if len(clip_models) > 0 else None,
+            help="Pretrained CLIP model to export",
+        )
+        parser.add_argument(
+            "-f",
+            "--format",
+            dest="fmt",
+            type=str,
+            choices=["onnx", "torchscript"],
+            default="onnx",
+            help="Format of the exported graphs",
+        )
+        parser.add_argument(
+            "--quantize",
+            dest="do_quantize",
+            action="store_true",
+            help="Also write int8 weight versions of the onnx graphs",
+        )
+        parser.add_argument(
+            "-t",
+            "--tolerance",
+            dest="tolerance",
+            type=float,
+            default=0.98,
+            help="Minimum cosine similarity to the eager outputs an exported graph must reach",
+        )
+        parser.add_argument(
+            "-b",
+            "--batch-size",
+            dest="batch_size",
+            type=int,
+            default=16,
+            help="Batch size of the throughput benchmark",
+        )
+        parser.add_argument(
+            "-n",
+            "--iterations",
+            dest="iterations",
+            type=int,
+            default=5,
+            help="Batches timed per backend, 0 skips the benchmark",
+        )
+
+        parser.set_defaults(func=self)
+
+    def __call__(
+        self,
+        pretrained_model,
+        fmt,
+        do_quantize,
+        tolerance,
+        batch_size,
+        iterations,
+        verbose,
+        *args,
+        **kwargs,
+    ):
+        if pretrained_model is None:
+            raise RuntimeError(
+                "No CLIP model is specified. Check your config file."
+            )
+        do_quantize = do_quantize and fmt == "onnx"
+        path = export_path(pretrained_model, self._work_dir)
+        model = CLIPModel.from_pretrained(pretrained_model)
+        processor = CLIPProcessor.from_pretrained(pretrained_model)
+
+        self._logger.info(f"Exporting {pretrained_model} to {fmt}...")
+        files = export_towers(model, processor, path, fmt, do_quantize)
+        for file in files:
+            self._logger.info(f"Written {file}")
+
+        backends = [(fmt, load_towers(pretrained_model, fmt, False, path))]
+        backend_files = {fmt: [x for x in files if ".int8." not in x.name]}
+        if do_quantize:
+            backends.append(
+                (f"{fmt} int8", load_towers(pretrained_model, fmt, True, path))
+            )
+            backend_files[f"{fmt} int8"] = [
+                x for x in files if ".int8." in x.name
+            ]
+        eager = EagerTowers(model)
+
+        size = model.config.vision_config.image_size
+        pixel_values = torch.randn(batch_size, 3, size, size)
+        tokens = processor(
+            text=[
+                "a person riding a bicycle",
+                "a red car parked next to a building at night",
+                "news anchor in a studio",
+            ],
+            return_tensors="pt",
+            padding="max_length",
+            truncation=True,
+        )
+        inputs = (pixel_values, tokens["input_ids"], tokens["attention_mask"])
+
+        reference = self._encode(eager, *inputs)
+        rows = [("eager", None, None)]
+        failed = []
+        for name, towers in backends:
+            diffs, cosines = self._compare(reference, towers, inputs)
+            rows.append((name, diffs, cosines))
+            if min(cosines) < tolerance:
+                failed.append(name)
+
+        throughput = {}
+        if iterations > 0:
+            for name, towers in [("eager", eager), *backends]:
+                throughput[name] = self._measure(
+                    towers, pixel_values, iterations
+                )
+
+        self._print_report(rows, throughput, batch_size)
+
+        if len(failed) > 0:
+            # Graphs that do not match are removed, so no backend can load
+            # them
+            for name in failed:
+                for file in backend_files[name]:
+                    file.unlink(missing_ok=True)
+            raise RuntimeError(
+                f"{', '.join(failed)}: outputs fall below cosine {tolerance} "
+                f"of the eager model, exported graphs were removed"
+            )
+
+    def _encode(self, towers, pixel_values, input_ids, attention_mask):
+        with torch.no_grad():
+            return (
+                towers.encode_images(pixel_values).cpu().numpy(),
+                towers.encode_texts(input_ids, attention_mask).cpu().numpy(),
+            )
+
+    def _compare(self, reference, towers, inputs):
+        # Max absolute difference and min cosine similarity to eager outputs
+        diffs = []
+        cosines = []
+        for x, y in zip(reference, self._encode(towers, *inputs)):
+            diffs.append(np.abs(x - y).max())
+            cosines.append(
+                (
+                    (x * y).sum(axis=1)
+                    / (np.linalg.norm(x, axis=1) * np.linalg.norm(y, axis=1))
+                ).min()
+            )
+        return diffs, cosines
+
+    def _measure(self, towers, pixel_values, iterations):
+        # Images per second of the vision tower on CPU, after one warm up
+        with torch.no_grad():
+            towers.encode_images(pixel_values)
+            start = time.perf_counter()
+            for _ in range(iterations):
+                towers.encode_images(pixel_values)
+            elapsed = time.perf_counter() - start
+        return len(pixel_values) * iterations / elapsed
+
+    def _print_report(self, rows, throughput, batch_size):
+        table = Table(title="CLIP export parity and CPU throughput")
+        table.add_column("backend")
+        for column in [
+            "image max diff",
+            "image min cos",
+            "text max diff",
+            "text min cos",
+        ]:
+            table.add_column(column, justify="right")
+        if len(throughput) > 0:
+            table.add_column(f"images/s (batch {batch_size})", justify="right")
+            table.add_column("speedup", justify="right")
+
+        for name, diffs, cosines in rows:
+            cells = ["-"] * 4
+            if diffs is not None:
+                cells = [
+                    f"{diffs[0]:.2e}",
+                    f"{cosines[0]:.5f}",
+                    f"{diffs[1]:.2e}",
+                    f"{cosines[1]:.5f}",
+                ]
+            if len(throughput) > 0:
+                cells.append(f"{throughput[name]:.1f}")
+                cells.append(f"{throughput[name] / throughput['eager']:.2f}x")
+            table.add_row(name, *cells)
+
+        Console().print(table)
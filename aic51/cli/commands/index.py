@@ -8,7 +8,15 @@ import numpy as np
 from rich.progress import Progress, SpinnerColumn, TextColumn, TimeElapsedColumn
 
 from .command import BaseCommand
-from ...packages.index import MilvusDatabase
+from ...packages.index import (
+    get_database_cls,
+    encode_video_id,
+    OCRIndex,
+    ocr_index_path,
+)
+from ...packages.cache import INDEX_STAMP, mark_stale
+from ...packages.manifest import Manifest, combine_hashes
+from ...packages.store import FeatureStore
 from ...config import GlobalConfig
 
 
@@ -27,6 +35,14 @@ class IndexCommand(BaseCommand):
             default="milvus",
             help="Name of collection to index",
         )
+        parser.add_argument(
+            "-b",
+            "--backend",
+            dest="backend",
+            type=str,
+            default=GlobalConfig.get("webui", "database") or "milvus",
+            help="Database backend to index into (milvus or local)",
+        )
         parser.add_argument(
             "-o",
             "--overwrite",
@@ -45,12 +61,23 @@ class IndexCommand(BaseCommand):
         parser.set_defaults(func=self)
 
     def __call__(
-        self, collection_name, do_overwrite, do_update, verbose, *args, **kwargs
+        self,
+        collection_name,
+        backend,
+        do_overwrite,
+        do_update,
+        verbose,
+        *args,
+        **kwargs,
     ):
-        MilvusDatabase.start_server()
-        database = MilvusDatabase(collection_name, do_overwrite)
-        features_dir = self._work_dir / "features"
-        keyframes_dir = self._work_dir / "keyframes"
+        database_cls = get_database_cls(backend)
+        database_cls.start_server()
+        database = database_cls(collection_name, do_overwrite, self._work_dir)
+        manifest = Manifest(self._work_dir)
+        store = FeatureStore(self._work_dir / "features")
+        stage = f"index:{collection_name}"
+        if do_overwrite:
+            manifest.reset_stage(stage)
         max_workers_ratio = GlobalConfig.get("max_workers_ratio") or 0
         with (
             Progress(
@@ -71,16 +98,34 @@ class IndexCommand(BaseCommand):
                 )
 
             def index_one_video(video_id):
+                # Videos are indexed again only when their features changed
+                input_hash = combine_hashes(
+                    *manifest.get_output_hashes(video_id, "features:")
+                )
+                if not do_update and manifest.is_done(
+                    video_id, stage, input_hash
+                ):
+                    return
                 task_id = progress.add_task(
                     description="Processing...", name=video_id
                 )
                 try:
-                    self._index_features(
-                        database,
-                        video_id,
-                        do_update,
-                        update_progress(task_id),
+                    manifest.start_stage(video_id, stage, input_hash)
+                    ocr_entries.extend(
+                        self._index_features(
+                            database,
+                            manifest,
+                            store,
+                            video_id,
+                            # Upserts keep records of re-indexed videos unique
+                            do_update or not do_overwrite,
+                            update_progress(task_id),
+                            # Re-extracting keyframes resets the video's
+                            # stages, so any existing collection is pruned
+                            not do_overwrite,
+                        )
                     )
+                    indexed[video_id] = input_hash
                     progress.update(
                         task_id,
                         completed=1,
@@ -90,67 +135,142 @@ class IndexCommand(BaseCommand):
                     progress.remove_task(task_id)
                 except Exception as e:
                     progress.update(task_id, description=f"Error: {str(e)}")
+                    self._logger.error(f"{video_id}: {str(e)}")
 
             futures = []
-            video_paths = sorted(
-                [d for d in keyframes_dir.glob("*/") if d.is_dir()],
-                key=lambda path: path.stem,
-            )
-            for video_path in video_paths:
-                video_id = video_path.stem
+            ocr_entries = []
+            indexed = {}
+            for video_id in manifest.scan(self._work_dir):
                 futures.append(executor.submit(index_one_video, video_id))
             for future in futures:
                 future.result()
 
+        database.flush()
+        for video_id, input_hash in indexed.items():
+            manifest.finish_stage(video_id, stage, input_hash)
+        manifest.close()
+        if len(indexed) == 0:
+            self._logger.info("Nothing to index")
+            return
+
+        # Frames of videos that were not indexed again keep their OCR lines
+        ocr_path = ocr_index_path(self._work_dir, collection_name)
+        if ocr_path.exists() and not do_overwrite:
+            ocr_entries.extend(
+                x
+                for x in OCRIndex.load(ocr_path).entries()
+                if x[0].split("#")[0] not in indexed
+            )
+        if len(ocr_entries) > 0 or ocr_path.exists():
+            self._logger.info(f"Building OCR index ({len(ocr_entries)} frames)")
+            OCRIndex.build(ocr_entries).save(ocr_path)
+        mark_stale(self._work_dir / INDEX_STAMP)
+
     def _extract_video_info(self, video_id):
         video_path = self._work_dir / "videos" / f"{video_id}.mp4"
         video_info_path = self._work_dir / "videos_info" / f"{video_id}.json"
         video_info_path.parent.mkdir(exist_ok=True, parents=True)
-        ffprobe_cmd = ["ffprobe", "-v", "quiet", "-of", "compact=p=0"] + [
+        ffprobe_cmd = ["ffprobe", "-v", "quiet", "-of", "json"] + [
             "-select_streams",
-            "0",
+            "v:0",
             "-show_entries",
-            "stream=r_frame_rate",
+            "stream=r_frame_rate,nb_frames,duration:format=duration",
             str(video_path),
         ]
         res = subprocess.run(ffprobe_cmd, capture_output=True, text=True)
+        probe = json.loads(res.stdout)
+        stream = probe["streams"][0]
 
-        fraction = str(res.stdout).split("=")[1].split("/")
-        frame_rate = round(int(fraction[0]) / int(fraction[1]))
+        fraction = stream["r_frame_rate"].split("/")
+        exact_frame_rate = int(fraction[0]) / int(fraction[1])
+        frame_rate = round(exact_frame_rate)
+        # Raw and elementary streams often report no duration
+        duration = stream.get("duration") or probe.get("format", {}).get(
+            "duration"
+        )
+        duration = float(duration) if duration is not None else None
+        frame_count = stream.get("nb_frames")
+        if frame_count is not None:
+            frame_count = int(frame_count)
+        elif duration is not None:
+            frame_count = round(duration * exact_frame_rate)
 
-        with open(video_info_path, "w") as f:
-            json.dump(dict(frame_rate=frame_rate), f)
+        # Written through a temporary file so the webui never reads a
+        # partial file and sees the directory change
+        tmp_path = video_info_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                dict(
+                    frame_rate=frame_rate,
+                    duration=duration,
+                    frame_count=frame_count,
+                ),
+                f,
+            )
+        os.replace(tmp_path, video_info_path)
 
-    def _index_features(self, database, video_id, do_update, update_progress):
+    def _index_features(
+        self,
+        database,
+        manifest,
+        store,
+        video_id,
+        do_update,
+        update_progress,
+        do_prune=False,
+    ):
         update_progress(description="Indexing...")
         self._extract_video_info(video_id)
-        features_dir = self._work_dir / "features" / video_id
-        data_list = []
-        for frame_path in features_dir.glob("*/"):
-            if not frame_path.is_dir():
-                continue
-            frame_id = frame_path.stem
-            data = {
+        frame_ids = manifest.get_frames(video_id)
+        frame_fields = None
+        # Collections created before video_idx/frame_idx existed reject them
+        if database.has_field("video_idx") and database.has_field("frame_idx"):
+            try:
+                video_idx = encode_video_id(video_id)
+                frame_fields = {
+                    frame_id: {
+                        "video_idx": video_idx,
+                        "frame_idx": int(frame_id),
+                    }
+                    for frame_id in frame_ids
+                }
+            except ValueError:
+                self._logger.warning(
+                    f"{video_id}: not a L##_V### id, indexed without video_idx and frame_idx"
+                )
+
+        frames = {}
+        for frame_id in frame_ids:
+            frames[frame_id] = {
                 "frame_id": f"{video_id}#{frame_id}",  # This is because Milvus does not allow composite primary key
+                **(frame_fields[frame_id] if frame_fields is not None else {}),
             }
-            for feature_path in frame_path.glob("*"):
-                if feature_path.is_dir():
-                    continue
-                if feature_path.suffix == ".npy":
-                    feature = np.load(feature_path)
-                elif feature_path.suffix == ".txt":
-                    with open(feature_path, "r") as f:
-                        feature = f.read()
-                        feature = feature.lower()
-                elif feature_path.suffix == ".json":
-                    with open(feature_path, "r") as f:
-                        feature = json.load(f)
-                else:
+
+        data_list = {}
+        for model in store.models(video_id):
+            frame_ids, values = store.read(video_id, model)
+            if isinstance(values, np.ndarray):
+                values = values.astype(database.get_vector_dtype(model))
+            for frame_id, feature in zip(frame_ids, values):
+                if frame_id not in frames:
                     continue
-                data = {
-                    **data,
-                    f"{feature_path.stem}": feature,
-                }
-            data_list.append(data)
+                if isinstance(feature, str):
+                    feature = feature.lower()
+                data_list.setdefault(frame_id, frames[frame_id])[
+                    model
+                ] = feature
 
-        database.insert(data_list, do_update)
+        ocr_entries = [
+            (data["frame_id"], [x[-2] for x in data["ocr"]])
+            for data in data_list.values()
+            if "ocr" in data
+        ]
+        if do_prune:
+            # Keyframes may have been extracted again since the last index,
+            # so rows of frames the video no longer has are removed
+            current = ", ".join([f'"{x["frame_id"]}"' for x in frames.values()])
+            database.delete(
+                f'frame_id like "{video_id}#%" && frame_id not in [{current}]'
+            )
+        database.insert(list(data_list.values()), do_update)
+        return ocr_entries
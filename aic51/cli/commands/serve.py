@@ -8,7 +8,8 @@ import uvicorn
 
 from .command import BaseCommand
 from ...config import GlobalConfig
-from ...packages.index import MilvusDatabase
+from ...packages.index import get_database_cls
+from ...packages.search.embedding import EmbeddingSidecar
 
 
 class ServeCommand(BaseCommand):
@@ -44,7 +45,9 @@ class ServeCommand(BaseCommand):
         parser.set_defaults(func=self)
 
     def __call__(self, port, dev_mode, workers, *args, **kwargs):
-        MilvusDatabase.start_server()
+        get_database_cls(
+            GlobalConfig.get("webui", "database") or "milvus"
+        ).start_server()
         self._install_frontend()
         if len(GlobalConfig.get("webui", "features") or []) == 0:
             self._logger.error(
@@ -75,14 +78,33 @@ class ServeCommand(BaseCommand):
             self._build_frontend(port)
             p = None
 
-        uvicorn.run(
-            f"aic51.packages.webui.backend.app:app",
-            host="0.0.0.0",
-            port=port,
-            log_level="info",
-            workers=workers,
-            **params,
-        )
+        sidecar = None
+        text_encoder = GlobalConfig.get("webui", "text_encoder") or {}
+        if workers > 1 and text_encoder.get("sidecar", True):
+            # Workers share one process holding the text encoders
+            sidecar = EmbeddingSidecar(
+                [
+                    x
+                    for x in GlobalConfig.get("webui", "features")
+                    if x["name"].lower() == "clip"
+                ],
+                text_encoder.get("dtype") or "float32",
+                GlobalConfig.get("webui", "text_batching"),
+            )
+            sidecar.start()
+
+        try:
+            uvicorn.run(
+                f"aic51.packages.webui.backend.app:app",
+                host="0.0.0.0",
+                port=port,
+                log_level="info",
+                workers=workers,
+                **params,
+            )
+        finally:
+            if sidecar is not None:
+                sidecar.stop()
         if dev_mode and p is not None:
             p.terminate()
             p.wait()
@@ -1,2 +1,28 @@
 from .clip import CLIP
+from .text_encoder import TextEncoder
 from .trorc import TrOCR
+
+
+def create_extractor(model_info):
+    model_name = model_info["name"].lower()
+    if model_name == "clip":
+        return CLIP(
+            model_info["pretrained_model"],
+            model_info.get("backend") or "eager",
+            model_info.get("quantize", False),
+        )
+    if model_name == "ocr":
+        return TrOCR()
+    raise ValueError(f"{model_name}: model is not available")
+
+
+def create_text_encoder(model_info, dtype="float32"):
+    model_name = model_info["name"].lower()
+    if model_name == "clip":
+        return TextEncoder(
+            model_info["pretrained_model"],
+            model_info.get("backend") or "eager",
+            model_info.get("quantize", False),
+            dtype,
+        )
+    raise ValueError(f"{model_name}: model has no text encoder")
@@ -0,0 +1,60 @@
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+
+class MicroBatcher(object):
+    def __init__(self, func, max_batch_size=32, max_wait_ms=5):
+        self._logger = logging.getLogger(
+            f'{".".join(__name__.split(".")[:-1])}.{self.__class__.__name__}'
+        )
+        self._func = func
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, items):
+        future = Future()
+        self._queue.put((items, future))
+        return future.result()
+
+    def _collect(self):
+        items, future = self._queue.get()
+        batch = [(items, future)]
+        size = len(items)
+        deadline = time.monotonic() + self._max_wait
+        while size < self._max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items, future = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append((items, future))
+            size += len(items)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # Requests often share items (e.g. several users paging the same
+            # query), so every distinct item is computed once
+            unique = list(dict.fromkeys(x for items, _ in batch for x in items))
+            self._logger.debug(
+                f"Merged {len(batch)} requests into a batch of {len(unique)}"
+            )
+            try:
+                outputs = dict(zip(unique, self._func(unique)))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for items, future in batch:
+                future.set_result([outputs[x] for x in items])
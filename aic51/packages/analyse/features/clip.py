@@ -1,53 +1,80 @@
-from transformers import CLIPModel, CLIPProcessor
+from math import ceil
+
+from transformers import CLIPProcessor
 from torch.utils.data import DataLoader
 import torch
 
 from ....config import GlobalConfig
-from .feature_extractor import FeatureExtractor, ImageDataset
+from .feature_extractor import FeatureExtractor, ImageDataset, prefetch
+from .text_encoder import TextEncoder
+from .towers import load_towers
 
 
-class CLIP(FeatureExtractor):
-    def __init__(self, pretrained_model):
-        self._model = CLIPModel.from_pretrained(pretrained_model)
+class CLIP(TextEncoder, FeatureExtractor):
+    # Both towers; text features come from TextEncoder through the
+    # processor's tokenizer
+    def __init__(self, pretrained_model, backend="eager", quantize=False):
+        self._pretrained_model = pretrained_model
+        self._backend = backend
+        self._towers = load_towers(pretrained_model, backend, quantize)
         self._processor = CLIPProcessor.from_pretrained(pretrained_model)
+        self._tokenizer = self._processor.tokenizer
+        self._text_cache = None
+        self._text_batcher = None
+        self._num_workers = None
 
-        self._model.eval()
+    def set_num_workers(self, num_workers):
+        # Overrides analyse.num_workers for the image DataLoader
+        self._num_workers = num_workers
 
     def get_image_features(self, image_paths, batch_size, callback):
-        dataset = ImageDataset(image_paths, self._processor)
+        # Batches are copied into a tensor allocated once the feature size
+        # is known, rather than concatenated on every batch
+        image_features = None
+        num_batches = ceil(len(image_paths) / batch_size)
+        callback(0, num_batches, None)
+        start = 0
+        for i, batch_features in enumerate(
+            self.iter_image_features(image_paths, batch_size)
+        ):
+            if image_features is None:
+                image_features = batch_features.new_empty(
+                    (len(image_paths), batch_features.shape[1])
+                )
+            image_features[start : start + len(batch_features)] = batch_features
+            start += len(batch_features)
+            callback(i + 1, num_batches, image_features[:start])
 
+        return image_features
+
+    def iter_image_features(self, image_paths, batch_size):
+        # Decoding and preprocessing run ahead of inference, in the
+        # DataLoader workers or, without workers, in a prefetch thread
+        dataset = ImageDataset(image_paths, self._processor)
+        num_workers = (
+            self._num_workers
+            if self._num_workers is not None
+            else GlobalConfig.get("analyse", "num_workers") or 0
+        )
         dataloader = DataLoader(
             dataset=dataset,
             batch_size=batch_size,
             shuffle=False,
             drop_last=False,
-            num_workers=GlobalConfig.get("analyse", "num_workers") or 0,
+            num_workers=num_workers,
             pin_memory=(
                 True if GlobalConfig.get("analyse", "pin_memory") else False
             ),
         )
-        image_features = None
-        num_batches = len(dataloader)
+        batches = (
+            dataloader
+            if num_workers > 0
+            else prefetch(
+                dataloader,
+                GlobalConfig.get("analyse", "prefetch_batches") or 2,
+            )
+        )
         with torch.no_grad():
-            callback(0, num_batches, None)
-            for i, data in enumerate(dataloader):
-                data.to(self._model.device)
-                batch_features = self._model.get_image_features(**data)
-                image_features = (
-                    torch.cat([image_features, batch_features])
-                    if image_features is not None
-                    else batch_features
-                )
-                callback(i + 1, num_batches, image_features)
-
-        return image_features
-
-    def get_text_features(self, texts):
-        tokenized_input = self._processor(text=texts, return_tensors="pt", padding=True)
-
-        text_features = self._model.get_text_features(**tokenized_input)
-
-        return text_features
-
-    def to(self, device):
-        self._model.to(device)
+            for data in batches:
+                data.to(self._towers.device)
+                yield self._towers.encode_images(data["pixel_values"])
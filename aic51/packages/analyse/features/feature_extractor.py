@@ -1,4 +1,6 @@
+import queue
 import logging
+import threading
 from typing import Any
 from abc import ABC, abstractmethod
 
@@ -27,11 +29,52 @@ class ImageDataset(Dataset):
         return processed_data
 
 
+def prefetch(iterable, depth=2):
+    # Iterates in a background thread, so the next items are loaded while
+    # the current one is processed. At most depth items are buffered.
+    items = queue.Queue(depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put(("item", item), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put(("end", None))
+        except Exception as e:
+            items.put(("error", e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, item = items.get()
+            if kind == "end":
+                break
+            if kind == "error":
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
 class FeatureExtractor(ABC):
     @abstractmethod
     def get_image_features(self, image_paths, batch_size, callback) -> Any:
         pass
 
+    @abstractmethod
+    def iter_image_features(self, image_paths, batch_size) -> Any:
+        # Yields the features of each batch in order, so callers can write
+        # them out without holding the whole output
+        pass
+
     @abstractmethod
     def get_text_features(self, texts) -> Any:
         pass
@@ -0,0 +1,86 @@
+from transformers import CLIPTokenizerFast
+import torch
+
+from .batcher import MicroBatcher
+from .towers import load_text_tower
+
+
+class TextEncoder(object):
+    # Embeds queries with the text tower and tokenizer of a CLIP model only,
+    # for processes that never see images
+    def __init__(
+        self, pretrained_model, backend="eager", quantize=False, dtype="float32"
+    ):
+        self._pretrained_model = pretrained_model
+        self._backend = backend
+        self._towers = load_text_tower(
+            pretrained_model, backend, quantize, dtype
+        )
+        self._tokenizer = CLIPTokenizerFast.from_pretrained(pretrained_model)
+        self._text_cache = None
+        self._text_batcher = None
+
+    def set_text_cache(self, cache):
+        self._text_cache = cache
+
+    def enable_text_batching(self, max_batch_size=32, max_wait_ms=5):
+        self._text_batcher = MicroBatcher(
+            self._encode_texts, max_batch_size, max_wait_ms
+        )
+
+    def get_text_features(self, texts):
+        # The tokenizer lowercases and collapses whitespace itself, so the
+        # normalized text maps to the same embedding as the raw one
+        texts = [" ".join(x.split()).lower() for x in texts]
+        text_features = [None] * len(texts)
+
+        missing = []
+        for i, text in enumerate(texts):
+            if self._text_cache is not None:
+                text_features[i] = self._text_cache.get(
+                    (self._pretrained_model, text)
+                )
+            if text_features[i] is None:
+                missing.append(i)
+
+        if len(missing) > 0:
+            missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+            if self._text_batcher is not None:
+                encoded = self._text_batcher.submit(missing_texts)
+            else:
+                encoded = self._encode_texts(missing_texts)
+            encoded = dict(zip(missing_texts, encoded))
+
+            for i in missing:
+                text_features[i] = encoded[texts[i]]
+            if self._text_cache is not None:
+                for text, feature in encoded.items():
+                    self._text_cache.put(
+                        (self._pretrained_model, text),
+                        feature,
+                        feature.element_size() * feature.nelement(),
+                    )
+
+        return torch.stack(text_features)
+
+    def _encode_texts(self, texts):
+        # Exported text graphs are traced at max_length
+        tokenized_input = self._tokenizer(
+            text=texts,
+            return_tensors="pt",
+            padding=True if self._backend == "eager" else "max_length",
+            truncation=self._backend != "eager",
+        )
+        tokenized_input.to(self._towers.device)
+
+        with torch.no_grad():
+            text_features = self._towers.encode_texts(
+                tokenized_input["input_ids"], tokenized_input["attention_mask"]
+            )
+
+        # Rows are cloned, as views would keep the whole batch alive in the
+        # text cache, which only charges them for their own bytes
+        return [x.clone() for x in text_features.cpu()]
+
+    def to(self, device):
+        self._towers.to(device)
@@ -0,0 +1,271 @@
+from pathlib import Path
+
+import numpy as np
+import torch
+from transformers import CLIPModel, CLIPTextModelWithProjection
+
+BACKENDS = ["eager", "onnx", "torchscript"]
+DTYPES = ["float32", "float16", "int8"]
+EXPORT_DIR = "models"
+
+
+def export_path(pretrained_model, work_dir=None):
+    # Exported graphs of a model live in <work_dir>/models/<model name>
+    work_dir = work_dir if work_dir is not None else Path.cwd()
+    return work_dir / EXPORT_DIR / pretrained_model.replace("/", "--")
+
+
+class VisionTower(torch.nn.Module):
+    def __init__(self, model):
+        super(VisionTower, self).__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.get_image_features(pixel_values=pixel_values)
+
+
+class TextTower(torch.nn.Module):
+    def __init__(self, model):
+        super(TextTower, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model.get_text_features(
+            input_ids=input_ids, attention_mask=attention_mask
+        )
+
+
+class EagerTowers(object):
+    def __init__(self, model):
+        self._model = model
+        self._model.eval()
+
+    @property
+    def device(self):
+        return self._model.device
+
+    def encode_images(self, pixel_values):
+        return self._model.get_image_features(pixel_values=pixel_values)
+
+    def encode_texts(self, input_ids, attention_mask):
+        return self._model.get_text_features(
+            input_ids=input_ids, attention_mask=attention_mask
+        )
+
+    def to(self, device):
+        self._model.to(device)
+
+
+class EagerTextTower(object):
+    def __init__(self, model):
+        self._model = model
+        self._model.eval()
+
+    @property
+    def device(self):
+        return next(self._model.parameters()).device
+
+    def encode_texts(self, input_ids, attention_mask):
+        outputs = self._model(
+            input_ids=input_ids, attention_mask=attention_mask
+        )
+        return outputs.text_embeds.float()
+
+    def to(self, device):
+        self._model.to(device)
+
+
+class TorchScriptTowers(object):
+    def __init__(self, path, towers=("vision", "text")):
+        self._path = path
+        self._towers = towers
+        self._device = torch.device("cpu")
+        self._load()
+
+    def _load(self):
+        # Freezing folds weights into the graph and fuses ops for inference
+        self._modules = {
+            name: torch.jit.optimize_for_inference(
+                torch.jit.load(
+                    self._path / f"{name}.pt", map_location=self._device
+                ).eval()
+            )
+            for name in self._towers
+        }
+
+    @property
+    def device(self):
+        return self._device
+
+    def encode_images(self, pixel_values):
+        return self._modules["vision"](pixel_values)
+
+    def encode_texts(self, input_ids, attention_mask):
+        return self._modules["text"](input_ids, attention_mask)
+
+    def to(self, device):
+        # Frozen graphs are specialised to a device, so they are reloaded
+        if torch.device(device) != self._device:
+            self._device = torch.device(device)
+            self._load()
+
+
+class OnnxTowers(object):
+    def __init__(self, path, quantize=False, towers=("vision", "text")):
+        import onnxruntime
+
+        self._onnxruntime = onnxruntime
+        self._path = path
+        self._files = {
+            name: path / (f"{name}.int8.onnx" if quantize else f"{name}.onnx")
+            for name in towers
+        }
+        self._device = torch.device("cpu")
+        self._load(["CPUExecutionProvider"])
+
+    def _load(self, providers):
+        options = self._onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            self._onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self._sessions = {
+            name: self._onnxruntime.InferenceSession(
+                str(path), options, providers=providers
+            )
+            for name, path in self._files.items()
+        }
+
+    @property
+    def device(self):
+        return self._device
+
+    def _run(self, name, inputs):
+        outputs = self._sessions[name].run(
+            None, {k: v.cpu().numpy() for k, v in inputs.items()}
+        )
+        return torch.from_numpy(np.asarray(outputs[0])).to(self._device)
+
+    def encode_images(self, pixel_values):
+        return self._run("vision", {"pixel_values": pixel_values})
+
+    def encode_texts(self, input_ids, attention_mask):
+        return self._run(
+            "text", {"input_ids": input_ids, "attention_mask": attention_mask}
+        )
+
+    def to(self, device):
+        device = torch.device(device)
+        if device.type == "cuda":
+            self._load(["CUDAExecutionProvider", "CPUExecutionProvider"])
+        elif device.type != "cpu":
+            raise ValueError(f"{device}: onnx backend only runs on cpu or cuda")
+        self._device = device
+
+
+def load_towers(
+    pretrained_model,
+    backend="eager",
+    quantize=False,
+    path=None,
+    towers=("vision", "text"),
+):
+    if backend not in BACKENDS:
+        raise ValueError(f"{backend}: CLIP backend is not available")
+    path = path if path is not None else export_path(pretrained_model)
+    if backend != "eager" and not path.exists():
+        raise RuntimeError(
+            f"{path}: no exported {pretrained_model}, run the export command"
+        )
+    if backend == "onnx":
+        return OnnxTowers(path, quantize, towers)
+    if backend == "torchscript":
+        return TorchScriptTowers(path, towers)
+    return EagerTowers(CLIPModel.from_pretrained(pretrained_model))
+
+
+def load_text_tower(
+    pretrained_model, backend="eager", quantize=False, dtype="float32"
+):
+    # Loads the text tower alone, leaving the vision weights on disk. dtype
+    # only applies to the eager backend: float16 is meant for gpu, int8
+    # quantizes the linear layers dynamically and runs on cpu only.
+    if dtype not in DTYPES:
+        raise ValueError(f"{dtype}: text encoder dtype is not available")
+    if backend != "eager":
+        return load_towers(
+            pretrained_model, backend, quantize, towers=("text",)
+        )
+
+    model = CLIPTextModelWithProjection.from_pretrained(
+        pretrained_model,
+        torch_dtype=torch.float16 if dtype == "float16" else torch.float32,
+    )
+    if dtype == "int8":
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return EagerTextTower(model)
+
+
+def export_towers(model, processor, path, fmt="onnx", quantize=True):
+    # Writes vision.* and text.* graphs with a dynamic batch size. Tracing
+    # bakes the causal mask of the text tower to the traced length, so
+    # exported text graphs always take max_length padded tokens. With
+    # quantize, onnx graphs also get int8 weight versions.
+    path.mkdir(parents=True, exist_ok=True)
+    model.eval()
+    size = model.config.vision_config.image_size
+    pixel_values = torch.randn(2, 3, size, size)
+    tokens = processor(
+        text=["a photo", "a photo of a street at night"],
+        return_tensors="pt",
+        padding="max_length",
+        truncation=True,
+    )
+    vision = VisionTower(model).eval()
+    text = TextTower(model).eval()
+    with torch.no_grad():
+        if fmt == "torchscript":
+            torch.jit.trace(vision, (pixel_values,)).save(path / "vision.pt")
+            torch.jit.trace(
+                text, (tokens["input_ids"], tokens["attention_mask"])
+            ).save(path / "text.pt")
+            return [path / "vision.pt", path / "text.pt"]
+
+        torch.onnx.export(
+            vision,
+            (pixel_values,),
+            path / "vision.onnx",
+            input_names=["pixel_values"],
+            output_names=["features"],
+            dynamic_axes={
+                "pixel_values": {0: "batch"},
+                "features": {0: "batch"},
+            },
+            opset_version=17,
+        )
+        torch.onnx.export(
+            text,
+            (tokens["input_ids"], tokens["attention_mask"]),
+            path / "text.onnx",
+            input_names=["input_ids", "attention_mask"],
+            output_names=["features"],
+            dynamic_axes={
+                "input_ids": {0: "batch"},
+                "attention_mask": {0: "batch"},
+                "features": {0: "batch"},
+            },
+            opset_version=17,
+        )
+    files = [path / "vision.onnx", path / "text.onnx"]
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        for name in ["vision", "text"]:
+            quantize_dynamic(
+                path / f"{name}.onnx",
+                path / f"{name}.int8.onnx",
+                weight_type=QuantType.QInt8,
+            )
+            files.append(path / f"{name}.int8.onnx")
+    return files
@@ -13,15 +13,26 @@ class TrOCR(FeatureExtractor):
 
     def get_image_features(self, image_paths, batch_size, callback):
         image_features = []
-        image_paths = [str(x) for x in image_paths]
         num_batches = ceil(len(image_paths) / batch_size)
         callback(0, num_batches, None)
+        for b, batch_features in enumerate(
+            self.iter_image_features(image_paths, batch_size)
+        ):
+            image_features.extend(batch_features)
+            callback(b + 1, num_batches, image_features)
+
+        return image_features
+
+    def iter_image_features(self, image_paths, batch_size):
+        image_paths = [str(x) for x in image_paths]
+        num_batches = ceil(len(image_paths) / batch_size)
         for b in range(num_batches):
             results = self._reader.readtext_batched(
                 image_paths[b * batch_size : (b + 1) * batch_size],
                 n_width=640,
                 n_height=360,
             )
+            batch_features = []
             for res in results:
                 detected_texts = [list(x) for x in res]
                 for i, x in enumerate(detected_texts):
@@ -32,10 +43,8 @@ class TrOCR(FeatureExtractor):
                         ]
                     detected_texts[i][-1] = float(x[-1])
 
-                image_features.append(detected_texts)
-            callback(b + 1, num_batches, image_features)
-
-        return image_features
+                batch_features.append(detected_texts)
+            yield batch_features
 
     def get_text_features(self, texts):
         return texts
@@ -0,0 +1,80 @@
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+from .features import CLIP, create_extractor
+
+_model = None
+
+
+def _init_worker(model_info, num_threads):
+    # Every worker owns its model and a fixed share of the cores, so
+    # workers do not oversubscribe the CPU with intra-op threads
+    global _model
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+    _model = create_extractor(model_info)
+    if isinstance(_model, CLIP):
+        _model.set_num_workers(0)
+    _model.to("cpu")
+
+
+def _run_shard(image_paths, batch_size):
+    features = []
+    for batch_features in _model.iter_image_features(image_paths, batch_size):
+        if isinstance(batch_features, torch.Tensor):
+            features.append(batch_features.cpu().numpy())
+        else:
+            features.extend(batch_features)
+    if len(features) > 0 and isinstance(features[0], np.ndarray):
+        return np.concatenate(features)
+    return features
+
+
+class InferencePool(object):
+    # CPU inference over a pool of processes. Keyframes are cut into shards
+    # of shard_batches batches, which run in parallel but are yielded in
+    # order. At most two shards per worker are in flight.
+    def __init__(
+        self, model_info, workers, threads_per_worker=1, shard_batches=4
+    ):
+        self._workers = workers
+        self._shard_batches = max(1, shard_batches)
+        self._executor = ProcessPoolExecutor(
+            workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(model_info, threads_per_worker),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def iter_image_features(self, image_paths, batch_size):
+        shard_size = batch_size * self._shard_batches
+        pending = deque()
+        try:
+            for start in range(0, len(image_paths), shard_size):
+                pending.append(
+                    self._executor.submit(
+                        _run_shard,
+                        image_paths[start : start + shard_size],
+                        batch_size,
+                    )
+                )
+                if len(pending) >= 2 * self._workers:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,89 @@
+import json
+from collections import deque
+
+import numpy as np
+
+
+class VideoJob(object):
+    def __init__(
+        self, video_id, frame_ids, paths, merge, digest, input_hash=None
+    ):
+        self.video_id = video_id
+        self.frame_ids = frame_ids
+        self.paths = paths
+        self.merge = merge
+        self.digest = digest
+        self.input_hash = input_hash
+        self.shard = None
+        self.features = []
+        self.done = 0
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+
+class FeatureRouter(object):
+    # Keyframes of many videos are fed to the model back to back, so its
+    # batches straddle videos. The router splits every batch of outputs at
+    # video boundaries, writes each part to its video's shard and commits a
+    # shard as soon as all frames of that video are written.
+    def __init__(self, store, model_name, jobs, on_done=None):
+        self._store = store
+        self._model_name = model_name
+        self._jobs = deque([x for x in jobs if len(x) > 0])
+        self._on_done = on_done
+
+    def route(self, batch_features):
+        start = 0
+        while start < len(batch_features):
+            if len(self._jobs) == 0:
+                raise RuntimeError("More features than keyframes were fed")
+            job = self._jobs[0]
+            count = min(len(job) - job.done, len(batch_features) - start)
+            self._write(job, batch_features[start : start + count])
+            start += count
+            if job.done == len(job):
+                self._jobs.popleft()
+                self._finish(job)
+
+    def _write(self, job, features):
+        if isinstance(features, np.ndarray):
+            if job.shard is None:
+                job.shard = self._store.create(
+                    job.video_id,
+                    self._model_name,
+                    job.frame_ids,
+                    features.shape[1],
+                    features.dtype,
+                )
+            job.shard.values[job.done : job.done + len(features)] = features
+            job.digest.update(features.tobytes())
+        else:
+            job.features.extend(features)
+            job.digest.update(json.dumps(features).encode("utf-8"))
+        job.done += len(features)
+
+    def _finish(self, job):
+        if job.shard is not None:
+            job.shard.commit(job.merge)
+        else:
+            self._store.write(
+                job.video_id,
+                self._model_name,
+                job.frame_ids,
+                job.features,
+                job.merge,
+            )
+        if self._on_done is not None:
+            self._on_done(job)
+
+    def pending(self):
+        return list(self._jobs)
+
+    def abort(self):
+        # Videos already committed are kept; the others are left to the
+        # next run
+        for job in self._jobs:
+            if job.shard is not None:
+                job.shard.abort()
+        self._jobs.clear()
@@ -0,0 +1,8 @@
+from .cache import (
+    BaseCache,
+    LRUCache,
+    TTLCache,
+    INDEX_STAMP,
+    create_cache,
+    mark_stale,
+)
@@ -0,0 +1,187 @@
+import os
+import sys
+import time
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+SIZE_SAMPLES = 8
+INDEX_STAMP = ".index_stamp"
+
+
+def estimate_size(obj):
+    # Containers are sized from a few sampled items so that estimating a
+    # 10k-record result does not walk every nested float
+    if isinstance(obj, np.ndarray):
+        return sys.getsizeof(obj) + (0 if obj.base is None else obj.nbytes)
+    if isinstance(obj, dict):
+        items = list(obj.items())
+        sample = items[:SIZE_SAMPLES]
+        per_item = (
+            sum(estimate_size(k) + estimate_size(v) for k, v in sample)
+            / len(sample)
+            if sample
+            else 0
+        )
+        return sys.getsizeof(obj) + int(per_item * len(items))
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        items = obj if isinstance(obj, (list, tuple)) else list(obj)
+        step = max(1, len(items) // SIZE_SAMPLES)
+        sample = items[::step][:SIZE_SAMPLES]
+        per_item = (
+            sum(estimate_size(x) for x in sample) / len(sample) if sample else 0
+        )
+        return sys.getsizeof(obj) + int(per_item * len(items))
+    return sys.getsizeof(obj)
+
+
+def mark_stale(stamp_file):
+    stamp_file = Path(stamp_file)
+    stamp_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(stamp_file, "w") as f:
+        f.write(str(time.time()))
+
+
+class BaseCache(ABC):
+    def __init__(self, max_bytes, stamp_file=None):
+        self._logger = logging.getLogger(
+            f'{".".join(__name__.split(".")[:-1])}.{self.__class__.__name__}'
+        )
+        self._max_bytes = max_bytes
+        self._stamp_file = Path(stamp_file) if stamp_file else None
+        self._stamp = self._read_stamp()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            self._check_stamp()
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._remove(key)
+                self.evictions += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._touch(key)
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        size = estimate_size(value) if size is None else size
+        with self._lock:
+            self._check_stamp()
+            if key in self._entries:
+                self._remove(key)
+            if size > self._max_bytes:
+                self._logger.debug(
+                    f"Entry of {size} bytes exceeds cache budget, not cached"
+                )
+                return
+
+            self._entries[key] = (value, size, time.monotonic())
+            self._size += size
+            while self._size > self._max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                policy=self.__class__.__name__,
+                entries=len(self._entries),
+                size_bytes=self._size,
+                max_bytes=self._max_bytes,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and not self._expired(entry)
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+    def _read_stamp(self):
+        if self._stamp_file is None:
+            return None
+        try:
+            return os.stat(self._stamp_file).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _check_stamp(self):
+        # The stamp file is rewritten by `aic51-cli index`, which runs in a
+        # different process than the one serving searches
+        stamp = self._read_stamp()
+        if stamp != self._stamp:
+            self._logger.info("Index has changed, invalidating cache")
+            self._stamp = stamp
+            self._entries.clear()
+            self._size = 0
+
+    @abstractmethod
+    def _expired(self, entry):
+        pass
+
+    @abstractmethod
+    def _touch(self, key):
+        pass
+
+
+class LRUCache(BaseCache):
+    def _expired(self, entry):
+        return False
+
+    def _touch(self, key):
+        self._entries.move_to_end(key)
+
+
+class TTLCache(BaseCache):
+    def __init__(self, max_bytes, ttl, stamp_file=None):
+        super(TTLCache, self).__init__(max_bytes, stamp_file)
+        self._ttl = ttl
+
+    def _expired(self, entry):
+        return time.monotonic() - entry[2] > self._ttl
+
+    def _touch(self, key):
+        pass
+
+    def stats(self):
+        return {**super(TTLCache, self).stats(), "ttl": self._ttl}
+
+
+def create_cache(config=None, stamp_file=None):
+    config = config or {}
+    policy = (config.get("policy") or "lru").lower()
+    max_bytes = config.get("max_bytes") or 512 * 1024 * 1024
+
+    if policy == "lru":
+        return LRUCache(max_bytes, stamp_file)
+    elif policy == "ttl":
+        return TTLCache(max_bytes, config.get("ttl") or 3600, stamp_file)
+    else:
+        raise ValueError(f"{policy}: cache policy is not available")
@@ -1 +1,16 @@
+from .database import VectorDatabase
 from .milvus import MilvusDatabase
+from .local import LocalDatabase
+from .ids import encode_video_id, parse_frame_id, frame_position
+from .ocr import OCRIndex, fold_text, ocr_index_path
+
+DATABASES = {
+    "milvus": MilvusDatabase,
+    "local": LocalDatabase,
+}
+
+
+def get_database_cls(name):
+    if name not in DATABASES:
+        raise ValueError(f"{name}: database is not available")
+    return DATABASES[name]
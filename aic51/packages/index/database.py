@@ -0,0 +1,64 @@
+from abc import ABC, abstractmethod
+
+
+class VectorDatabase(ABC):
+    SEARCH_LIMIT = 10000
+
+    @abstractmethod
+    def insert(self, data, do_update=False):
+        pass
+
+    @abstractmethod
+    def delete(self, filter):
+        pass
+
+    @abstractmethod
+    def get(self, id, output_fields=None):
+        pass
+
+    @abstractmethod
+    def get_many(self, ids, output_fields=None):
+        pass
+
+    @abstractmethod
+    def query(self, filter, offset=0, limit=50, output_fields=None):
+        pass
+
+    @abstractmethod
+    def search(
+        self,
+        query,
+        filter="",
+        offset=0,
+        limit=50,
+        nprobe=8,
+        feature="clip",
+        output_fields=None,
+        exact=False,
+    ):
+        pass
+
+    @abstractmethod
+    def get_total(self):
+        pass
+
+    @abstractmethod
+    def has_field(self, field):
+        pass
+
+    def get_nlist(self, feature="clip"):
+        return None
+
+    def get_vector_dtype(self, feature="clip"):
+        return "float32"
+
+    def flush(self):
+        pass
+
+    @classmethod
+    def start_server(cls):
+        pass
+
+    @classmethod
+    def stop_server(cls):
+        pass
@@ -0,0 +1,193 @@
+import re
+from functools import lru_cache
+
+import numpy as np
+
+TOKEN_RE = re.compile(
+    r"""\s*(?:
+        (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+        |(?P<number>-?\d+(?:\.\d+)?)
+        |(?P<op>&&|\|\||==|!=|>=|<=|>|<|!|\(|\)|\[|\]|,)
+        |(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    )""",
+    re.VERBOSE,
+)
+COMPARISONS = {
+    "==": np.equal,
+    "!=": np.not_equal,
+    ">=": np.greater_equal,
+    "<=": np.less_equal,
+    ">": np.greater,
+    "<": np.less,
+}
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+def tokenize(expr):
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        match = TOKEN_RE.match(expr, pos)
+        if match is None:
+            raise ExpressionError(f"Unexpected character at {pos}: {expr!r}")
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = re.sub(r"\\(.)", r"\1", value[1:-1])
+        elif kind == "number":
+            value = float(value) if "." in value else int(value)
+        elif kind == "name" and value.lower() in ["and", "or", "not", "in"]:
+            kind = "op"
+            value = {"and": "&&", "or": "||", "not": "!", "in": "in"}[
+                value.lower()
+            ]
+        elif kind == "name" and value.lower() == "like":
+            kind = "op"
+            value = "like"
+        tokens.append((kind, value))
+    return tokens
+
+
+class _Parser(object):
+    # Recursive descent over the subset of the Milvus boolean expression
+    # grammar the searcher emits. Each node compiles to a function that maps
+    # the column dict to a boolean mask.
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self._pos = 0
+
+    def parse(self):
+        node = self._or()
+        if self._pos != len(self._tokens):
+            raise ExpressionError(f"Unexpected token {self._peek()}")
+        return node
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self._pos += 1
+        return token
+
+    def _expect(self, kind, value=None):
+        token = self._next()
+        if token[0] != kind or (value is not None and token[1] != value):
+            raise ExpressionError(f"Expected {value or kind}, got {token}")
+        return token[1]
+
+    def _or(self):
+        nodes = [self._and()]
+        while self._peek() == ("op", "||"):
+            self._next()
+            nodes.append(self._and())
+        if len(nodes) == 1:
+            return nodes[0]
+        return lambda columns: np.logical_or.reduce([n(columns) for n in nodes])
+
+    def _and(self):
+        nodes = [self._unary()]
+        while self._peek() == ("op", "&&"):
+            self._next()
+            nodes.append(self._unary())
+        if len(nodes) == 1:
+            return nodes[0]
+        return lambda columns: np.logical_and.reduce(
+            [n(columns) for n in nodes]
+        )
+
+    def _unary(self):
+        if self._peek() == ("op", "!"):
+            self._next()
+            node = self._unary()
+            return lambda columns: np.logical_not(node(columns))
+        if self._peek() == ("op", "("):
+            self._next()
+            node = self._or()
+            self._expect("op", ")")
+            return node
+        return self._comparison()
+
+    def _value(self):
+        kind, value = self._next()
+        if kind not in ["string", "number"]:
+            raise ExpressionError(f"Expected a literal, got {value!r}")
+        return value
+
+    def _comparison(self):
+        field = self._expect("name")
+        kind, op = self._next()
+        if kind != "op":
+            raise ExpressionError(f"Expected an operator after {field}")
+
+        if op == "like":
+            return _like(field, self._value())
+        if op == "!" and self._peek() == ("op", "in"):
+            self._next()
+            node = self._in(field)
+            return lambda columns: np.logical_not(node(columns))
+        if op == "in":
+            return self._in(field)
+        if op in COMPARISONS:
+            value = self._value()
+            func = COMPARISONS[op]
+            return lambda columns: func(_column(columns, field), value)
+        raise ExpressionError(f"Unsupported operator {op!r}")
+
+    def _in(self, field):
+        self._expect("op", "[")
+        values = []
+        while self._peek() != ("op", "]"):
+            values.append(self._value())
+            if self._peek() == ("op", ","):
+                self._next()
+        self._expect("op", "]")
+        return lambda columns: np.isin(_column(columns, field), values)
+
+
+def _column(columns, field):
+    if field not in columns:
+        raise ExpressionError(f"{field}: field is not filterable")
+    return columns[field]
+
+
+def _like(field, pattern):
+    body = pattern.strip("%")
+    if "%" not in body and "_" not in body:
+        if pattern.startswith("%") and pattern.endswith("%"):
+            return (
+                lambda columns: np.char.find(_column(columns, field), body) >= 0
+            )
+        if pattern.endswith("%"):
+            return lambda columns: np.char.startswith(
+                _column(columns, field), body
+            )
+        if pattern.startswith("%"):
+            return lambda columns: np.char.endswith(
+                _column(columns, field), body
+            )
+        return lambda columns: _column(columns, field) == body
+
+    regex = re.compile(
+        "".join(
+            ".*" if c == "%" else "." if c == "_" else re.escape(c)
+            for c in pattern
+        )
+        + "$"
+    )
+    match = np.vectorize(lambda x: regex.match(x) is not None, otypes=[bool])
+    return lambda columns: match(_column(columns, field))
+
+
+@lru_cache(maxsize=1024)
+def compile_filter(expr):
+    if expr is None or len(expr.strip()) == 0:
+        return None
+    return _Parser(tokenize(expr)).parse()
@@ -0,0 +1,44 @@
+import numpy as np
+
+from .ivf import normalize
+
+
+class FlatIndex(object):
+    CHUNK = 65536
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def search(self, queries, k, rows=None):
+        # Exact top-k by inner product over normalized vectors. The matrix
+        # is scanned in chunks so a memory-mapped corpus never has to be
+        # fully resident, and each chunk is one BLAS matrix product.
+        queries = normalize(queries)
+        num_rows = len(self.vectors) if rows is None else len(rows)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+
+        for start in range(0, num_rows, self.CHUNK):
+            end = min(start + self.CHUNK, num_rows)
+            if rows is None:
+                chunk_rows = np.arange(start, end)
+                chunk = self.vectors[start:end]
+            else:
+                chunk_rows = rows[start:end]
+                chunk = self.vectors[chunk_rows]
+            scores = queries @ np.asarray(chunk, dtype=np.float32).T
+
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_rows = np.concatenate(
+                [best_rows, np.broadcast_to(chunk_rows, scores.shape)], axis=1
+            )
+            if best_scores.shape[1] > k:
+                idx = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, idx, axis=1)
+                best_rows = np.take_along_axis(best_rows, idx, axis=1)
+
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return (
+            np.take_along_axis(best_rows, order, axis=1),
+            np.take_along_axis(best_scores, order, axis=1),
+        )
@@ -0,0 +1,17 @@
+def encode_video_id(video_id):
+    return int(video_id.replace("L", "").replace("_V", ""))
+
+
+def parse_frame_id(frame_id):
+    video_id, frame_id = frame_id.split("#")
+    return encode_video_id(video_id), int(frame_id)
+
+
+def frame_position(entity):
+    # Collections indexed with the integer columns need no string parsing
+    if (
+        entity.get("video_idx") is not None
+        and entity.get("frame_idx") is not None
+    ):
+        return entity["video_idx"], entity["frame_idx"]
+    return parse_frame_id(entity["frame_id"])
@@ -0,0 +1,88 @@
+import numpy as np
+
+ASSIGN_CHUNK = 65536
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def top_k(scores, k):
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+
+class IVFIndex(object):
+    def __init__(self, centroids, order, offsets):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, vectors, nlist, iterations=10, samples_per_list=256, seed=0):
+        # Spherical k-means on a sample, then every vector goes to its
+        # closest centroid. Inverted lists are stored as one permutation of
+        # the row ids plus list offsets.
+        rng = np.random.default_rng(seed)
+        num_vectors = len(vectors)
+        nlist = max(1, min(nlist, num_vectors))
+
+        sample_idx = np.sort(
+            rng.choice(
+                num_vectors,
+                min(num_vectors, nlist * samples_per_list),
+                replace=False,
+            )
+        )
+        sample = normalize(vectors[sample_idx])
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=nlist)
+            non_empty = counts > 0
+            centroids[non_empty] = normalize(sums[non_empty])
+
+        assignment = np.empty(num_vectors, dtype=np.int64)
+        for start in range(0, num_vectors, ASSIGN_CHUNK):
+            chunk = normalize(vectors[start : start + ASSIGN_CHUNK])
+            assignment[start : start + len(chunk)] = np.argmax(
+                chunk @ centroids.T, axis=1
+            )
+
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=nlist), out=offsets[1:])
+        return cls(centroids, order, offsets)
+
+    def candidates(self, query, nprobe):
+        lists = top_k(self.centroids @ query, nprobe)
+        rows = np.concatenate(
+            [self.order[self.offsets[l] : self.offsets[l + 1]] for l in lists]
+        )
+        # Sorted rows keep reads from a memory-mapped matrix sequential
+        return np.sort(rows)
+
+    def save(self, path):
+        np.savez(
+            path,
+            centroids=self.centroids,
+            order=self.order,
+            offsets=self.offsets,
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["centroids"], data["order"], data["offsets"])
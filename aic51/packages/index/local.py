@@ -0,0 +1,382 @@
+import os
+import json
+import shutil
+import logging
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from ...config import GlobalConfig
+from .database import VectorDatabase
+from .expression import compile_filter
+from .ivf import IVFIndex, normalize
+from .flat import FlatIndex
+from .quantization import SQ8Codes
+
+
+class LocalData(object):
+    # Everything loaded from one flushed version of a collection. It is
+    # replaced as a whole, so a search running during a reload sees either
+    # the old or the new version, never a mix.
+    def __init__(self, path=None, primary_field="frame_id"):
+        self.scalars = {}
+        self.vectors = {}
+        self.codes = {}
+        self.indices = {}
+        self.mtime = None
+
+        meta_path = path / "meta.json" if path is not None else None
+        if meta_path is not None and meta_path.exists():
+            self.mtime = os.stat(meta_path).st_mtime_ns
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            with open(path / "scalars.json", "r") as f:
+                self.scalars = json.load(f)
+            for field in meta["vectors"]:
+                self.vectors[field] = np.load(
+                    path / f"{field}.npy", mmap_mode="r"
+                )
+                index_path = path / f"{field}.ivf.npz"
+                if index_path.exists():
+                    self.indices[field] = IVFIndex.load(index_path)
+                codes_path = path / f"{field}.sq8.npz"
+                if codes_path.exists():
+                    self.codes[field] = SQ8Codes.load(codes_path)
+
+        self.ids = self.scalars.get(primary_field, [])
+        self.positions = {id: i for i, id in enumerate(self.ids)}
+        self.columns = {}
+        for field, values in self.scalars.items():
+            first = next((x for x in values if x is not None), None)
+            # Only plain scalar columns can appear in filter expressions. Rows
+            # without a value (e.g. video_idx of ids that do not parse) match
+            # no comparison.
+            if isinstance(first, str):
+                self.columns[field] = np.array(values, dtype=str)
+            elif isinstance(first, (int, float)):
+                self.columns[field] = np.array(
+                    [np.nan if x is None else x for x in values]
+                )
+
+    def is_complete(self):
+        # Files of a flush still being written do not line up yet
+        return all(len(x) == len(self.ids) for x in self.vectors.values())
+
+
+class LocalDatabase(VectorDatabase):
+    EXACT_THRESHOLD = 4096
+    COPY_CHUNK = 65536
+
+    def __init__(self, collection_name, do_overwrite=False, work_dir=None):
+        self._collection_name = collection_name
+        self._logger = logging.getLogger(__name__)
+
+        config = GlobalConfig.get("local") or {}
+        work_dir = Path(work_dir) if work_dir is not None else Path.cwd()
+        self._path = (
+            work_dir / (config.get("path") or ".local_index") / collection_name
+        )
+        # sq8 scans 8-bit codes and re-ranks the best candidates with the
+        # float16 vectors, which stay memory-mapped on disk
+        dtype = config.get("dtype") or "float32"
+        self._quantize = dtype == "sq8"
+        self._dtype = np.dtype("float16" if self._quantize else dtype)
+        self._rerank_factor = config.get("rerank_factor") or 4
+        self._nlist = config.get("nlist") or 128
+        self._primary_field = next(
+            (
+                field["field_name"]
+                for field in GlobalConfig.get("milvus", "fields") or []
+                if field.get("is_primary")
+            ),
+            "frame_id",
+        )
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._deleted = set()
+
+        if do_overwrite and self._path.exists():
+            shutil.rmtree(self._path)
+        self._load()
+
+    def _load(self):
+        self._data = LocalData(self._path, self._primary_field)
+
+    def _get_data(self):
+        # `aic51-cli index` rewrites the collection from another process;
+        # meta.json is replaced last in a flush, so its mtime tells when a
+        # new version is complete. While a rebuild has not flushed yet (or
+        # the directory was removed by -o), the loaded version keeps serving.
+        data = self._data
+        try:
+            mtime = os.stat(self._path / "meta.json").st_mtime_ns
+        except FileNotFoundError:
+            return data
+        if mtime == data.mtime:
+            return data
+        with self._lock:
+            if self._data.mtime != mtime:
+                new_data = LocalData(self._path, self._primary_field)
+                if new_data.is_complete():
+                    self._data = new_data
+            return self._data
+
+    def insert(self, data, do_update=False):
+        with self._lock:
+            for record in data:
+                self._pending[record[self._primary_field]] = record
+                self._deleted.discard(record[self._primary_field])
+        return {"insert_count": len(data)}
+
+    def delete(self, filter):
+        # Like inserts, deletes of flushed rows take effect on the next flush
+        data = self._get_data()
+        if len(data.ids) == 0:
+            return {"delete_count": 0}
+        mask = self._filter_mask(data, filter)
+        if mask is None:
+            raise ValueError("Deleting requires a filter")
+        ids = [data.ids[i] for i in np.flatnonzero(mask)]
+        with self._lock:
+            for id in ids:
+                self._pending.pop(id, None)
+            self._deleted.update(ids)
+        return {"delete_count": len(ids)}
+
+    def flush(self):
+        with self._lock:
+            if len(self._pending) == 0 and len(self._deleted) == 0:
+                return
+            pending = self._pending
+            deleted = self._deleted
+            self._pending = {}
+            self._deleted = set()
+
+        self._path.mkdir(parents=True, exist_ok=True)
+        data = self._data
+        # Rows of the loaded version that survive, in their order
+        keep = None
+        positions = dict(data.positions)
+        ids = list(data.ids)
+        if any(id in positions for id in deleted):
+            keep = np.array(
+                [i for i, id in enumerate(data.ids) if id not in deleted],
+                dtype=np.int64,
+            )
+            ids = [data.ids[i] for i in keep]
+            positions = {id: i for i, id in enumerate(ids)}
+        for id in pending:
+            if id not in positions:
+                positions[id] = len(ids)
+                ids.append(id)
+
+        vector_fields = set(data.vectors.keys())
+        scalar_fields = set(data.scalars.keys())
+        for record in pending.values():
+            for field, value in record.items():
+                if isinstance(value, np.ndarray):
+                    vector_fields.add(field)
+                else:
+                    scalar_fields.add(field)
+
+        scalars = {}
+        for field in scalar_fields:
+            values = list(data.scalars.get(field, [None] * len(data.ids)))
+            if keep is not None:
+                values = [values[i] for i in keep]
+            values.extend([None] * (len(ids) - len(values)))
+            for id, record in pending.items():
+                if field in record:
+                    values[positions[id]] = record[field]
+            scalars[field] = values
+
+        for field in vector_fields:
+            self._write_vectors(data, field, pending, positions, len(ids), keep)
+
+        self._write_json(self._path / "scalars.json", scalars)
+        self._write_json(
+            self._path / "meta.json",
+            dict(
+                count=len(ids),
+                primary_field=self._primary_field,
+                vectors=sorted(vector_fields),
+            ),
+        )
+        self._load()
+
+    def _write_json(self, path, obj):
+        tmp_path = path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, path)
+
+    def _write_vectors(
+        self, data, field, pending, positions, num_rows, keep=None
+    ):
+        old = data.vectors.get(field)
+        dim = (
+            old.shape[1]
+            if old is not None
+            else next(len(x[field]) for x in pending.values() if field in x)
+        )
+
+        tmp_path = self._path / f"{field}.npy.tmp"
+        vectors = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=self._dtype, shape=(num_rows, dim)
+        )
+        if old is not None:
+            num_old = len(old) if keep is None else len(keep)
+            for start in range(0, num_old, self.COPY_CHUNK):
+                end = min(start + self.COPY_CHUNK, num_old)
+                vectors[start:end] = (
+                    old[start:end] if keep is None else old[keep[start:end]]
+                )
+        for id, record in pending.items():
+            if field in record:
+                vectors[positions[id]] = normalize(record[field])
+        vectors.flush()
+        del vectors
+        os.replace(tmp_path, self._path / f"{field}.npy")
+
+        vectors = np.load(self._path / f"{field}.npy", mmap_mode="r")
+        self._logger.info(
+            f"Building IVF index for {field} ({num_rows} rows, nlist={self._nlist})"
+        )
+        IVFIndex.train(vectors, self._nlist).save(
+            self._path / f"{field}.ivf.npz"
+        )
+
+        codes_path = self._path / f"{field}.sq8.npz"
+        if self._quantize:
+            SQ8Codes.train(vectors).save(codes_path)
+        elif codes_path.exists():
+            codes_path.unlink()
+
+    def _filter_mask(self, data, filter):
+        func = compile_filter(filter)
+        if func is None:
+            return None
+        mask = np.asarray(func(data.columns), dtype=bool)
+        return np.broadcast_to(mask, (len(data.ids),))
+
+    def _entity(self, data, row, output_fields):
+        fields = output_fields
+        if fields is None or "*" in fields:
+            fields = list(data.scalars.keys()) + list(data.vectors.keys())
+
+        entity = {}
+        for field in fields:
+            if field in data.scalars:
+                entity[field] = data.scalars[field][row]
+            elif field in data.vectors:
+                entity[field] = (
+                    data.vectors[field][row].astype(np.float32).tolist()
+                )
+        return entity
+
+    def _candidates(self, data, feature, query, nprobe, mask, exact):
+        index = None if exact else data.indices.get(feature)
+        if mask is not None:
+            allowed = np.flatnonzero(mask)
+            if index is None or len(allowed) <= self.EXACT_THRESHOLD:
+                return allowed
+        elif index is None:
+            return None
+
+        rows = index.candidates(query, nprobe)
+        if mask is not None:
+            rows = rows[mask[rows]]
+        return rows
+
+    def _rerank(self, vectors, query, rows, k):
+        scores = np.asarray(vectors[rows], dtype=np.float32) @ query
+        order = np.argsort(-scores, kind="stable")[:k]
+        return rows[order], scores[order]
+
+    def get(self, id, output_fields=None):
+        return self.get_many([id], output_fields)
+
+    def get_many(self, ids, output_fields=None):
+        data = self._get_data()
+        return [
+            self._entity(data, data.positions[id], output_fields)
+            for id in ids
+            if id in data.positions
+        ]
+
+    def query(self, filter, offset=0, limit=50, output_fields=None):
+        data = self._get_data()
+        limit = min(limit, self.SEARCH_LIMIT)
+        mask = self._filter_mask(data, filter)
+        rows = (
+            np.flatnonzero(mask) if mask is not None else range(len(data.ids))
+        )
+        return [
+            self._entity(data, int(row), output_fields)
+            for row in rows[offset : offset + limit]
+        ]
+
+    def search(
+        self,
+        query,
+        filter="",
+        offset=0,
+        limit=50,
+        nprobe=8,
+        feature="clip",
+        output_fields=None,
+        exact=False,
+    ):
+        data = self._get_data()
+        limit = min(limit, self.SEARCH_LIMIT)
+        vectors = data.vectors.get(feature)
+        if vectors is None:
+            return [[] for _ in query]
+
+        mask = self._filter_mask(data, filter)
+        codes = None if exact else data.codes.get(feature)
+        flat = FlatIndex(codes if codes is not None else vectors)
+        k = offset + limit
+        res = []
+        for q in normalize(query):
+            rows = self._candidates(data, feature, q, nprobe, mask, exact)
+            if codes is None:
+                best_rows, best_scores = flat.search([q], k, rows)
+                best_rows, best_scores = best_rows[0], best_scores[0]
+            else:
+                best_rows, _ = flat.search([q], k * self._rerank_factor, rows)
+                best_rows, best_scores = self._rerank(
+                    vectors, q, best_rows[0], k
+                )
+
+            hits = []
+            for row, score in zip(best_rows[offset:], best_scores[offset:]):
+                row = int(row)
+                hits.append(
+                    {
+                        "id": data.ids[row],
+                        "distance": float(score),
+                        "entity": self._entity(data, row, output_fields),
+                    }
+                )
+            res.append(hits)
+        return res
+
+    def get_nlist(self, feature="clip"):
+        index = self._get_data().indices.get(feature)
+        return index.nlist if index is not None else None
+
+    def has_field(self, field):
+        data = self._get_data()
+        # An empty collection takes the configured fields on its first flush
+        if len(data.ids) == 0:
+            return any(
+                x["field_name"] == field
+                for x in GlobalConfig.get("milvus", "fields") or []
+            )
+        return field in data.scalars or field in data.vectors
+
+    def get_total(self):
+        return len(self._get_data().ids)
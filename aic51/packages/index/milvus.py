@@ -5,12 +5,15 @@ import subprocess
 from pathlib import Path
 from thefuzz import fuzz
 
+import numpy as np
 from pymilvus import DataType, MilvusClient
 from ...config import GlobalConfig
+from .database import VectorDatabase
+from .ivf import normalize
 
 
-class MilvusDatabase(object):
-    SEARCH_LIMIT = 10000
+class MilvusDatabase(VectorDatabase):
+    GET_BATCH_SIZE = 1000
     DATATYPE_MAP = {
         "BOOL": DataType.BOOL,
         "INT8": DataType.INT8,
@@ -28,11 +31,31 @@ class MilvusDatabase(object):
         "ARRAY": DataType.ARRAY,
     }
 
-    def __init__(self, collection_name, do_overwrite=False):
+    def __init__(self, collection_name, do_overwrite=False, work_dir=None):
         self._collection_name = collection_name
         self._logger = logging.getLogger(__name__)
         self._client = MilvusClient("http://localhost:19530")
 
+        self._vector_dtypes = {
+            field["field_name"]: (
+                np.float16
+                if field["datatype"]
+                in ["FLOAT16_VECTOR", DataType.FLOAT16_VECTOR]
+                else np.float32
+            )
+            for field in GlobalConfig.get("milvus", "fields") or []
+            if "VECTOR" in str(field.get("datatype"))
+        }
+        self._rerank_factor = GlobalConfig.get("milvus", "rerank_factor") or 1
+        self._primary_field = next(
+            (
+                field["field_name"]
+                for field in GlobalConfig.get("milvus", "fields") or []
+                if field.get("is_primary")
+            ),
+            "frame_id",
+        )
+
         collection_exists = self._client.has_collection(collection_name)
 
         if do_overwrite or not collection_exists:
@@ -60,6 +83,13 @@ class MilvusDatabase(object):
                 collection_name, schema=schema, index_params=index_params
             )
 
+        self._fields = set(
+            field["name"]
+            for field in self._client.describe_collection(collection_name)[
+                "fields"
+            ]
+        )
+
     def __del__(self):
         self._client.close()
 
@@ -69,17 +99,37 @@ class MilvusDatabase(object):
         else:
             return self._client.insert(self._collection_name, data)
 
-    def get(self, id):
-        res = self._client.get(self._collection_name, ids=[id])
-        return res
+    def delete(self, filter):
+        return self._client.delete(self._collection_name, filter=filter)
+
+    def get(self, id, output_fields=None):
+        res = self._client.get(
+            self._collection_name, ids=[id], output_fields=output_fields
+        )
+        return [self._decode_vectors(record) for record in res]
 
-    def query(self, filter, offset=0, limit=50):
+    def get_many(self, ids, output_fields=None):
+        records = {}
+        for i in range(0, len(ids), self.GET_BATCH_SIZE):
+            res = self._client.get(
+                self._collection_name,
+                ids=ids[i : i + self.GET_BATCH_SIZE],
+                output_fields=output_fields,
+            )
+            for record in res:
+                records[record[self._primary_field]] = self._decode_vectors(
+                    record
+                )
+        return [records[id] for id in ids if id in records]
+
+    def query(self, filter, offset=0, limit=50, output_fields=None):
         limit = min(limit, self.SEARCH_LIMIT)
         res = self._client.query(
             self._collection_name,
             filter=filter,
             offset=offset,
             limit=limit,
+            output_fields=output_fields,
         )
         return res
 
@@ -91,26 +141,100 @@ class MilvusDatabase(object):
         limit=50,
         nprobe=8,
         feature="clip",
+        output_fields=None,
+        exact=False,
     ):
         limit = min(limit, self.SEARCH_LIMIT)
+        if exact:
+            # Probing every list of an IVF index scans the whole collection
+            nprobe = self.get_nlist(feature) or nprobe
         search_params = {
             "metric_type": "COSINE",
             "params": {
                 "nprobe": nprobe,
             },
         }
+        output_fields = output_fields or ["*"]
+
+        # Compressed indices (IVF_SQ8, IVF_PQ) are oversampled and the best
+        # candidates re-scored with the stored full-precision vectors
+        rerank = self._rerank_factor > 1 and not exact
+        keep_vector = "*" in output_fields or feature in output_fields
         res = self._client.search(
             self._collection_name,
-            data=query,
+            data=self._encode_query(query, feature),
             anns_field=f"{feature}",
             filter=filter,
-            offset=offset,
-            limit=limit,
+            offset=0 if rerank else offset,
+            limit=(
+                min((offset + limit) * self._rerank_factor, self.SEARCH_LIMIT)
+                if rerank
+                else limit
+            ),
             search_params=search_params,
-            output_fields=["*"],
+            output_fields=(
+                output_fields
+                if keep_vector or not rerank
+                else output_fields + [feature]
+            ),
         )
+        if rerank:
+            res = [
+                self._rerank(q, hits, feature, offset, limit, keep_vector)
+                for q, hits in zip(query, res)
+            ]
         return res
 
+    def _encode_query(self, query, feature):
+        dtype = self.get_vector_dtype(feature)
+        if dtype == np.float32:
+            return query
+        return [np.asarray(q, dtype=dtype) for q in query]
+
+    def _decode_vectors(self, record):
+        # FLOAT16_VECTOR values come back as raw little-endian bytes
+        for field, dtype in self._vector_dtypes.items():
+            value = record.get(field)
+            if dtype == np.float32 or value is None:
+                continue
+            if isinstance(value, list) and len(value) == 1:
+                value = value[0]
+            if isinstance(value, bytes):
+                record[field] = np.frombuffer(value, dtype=dtype).tolist()
+        return record
+
+    def _rerank(self, query, hits, feature, offset, limit, keep_vector):
+        if len(hits) == 0:
+            return hits
+        hits = [
+            {**hit, "entity": self._decode_vectors(dict(hit["entity"]))}
+            for hit in hits
+        ]
+        vectors = normalize([hit["entity"][feature] for hit in hits])
+        scores = vectors @ normalize(query)
+
+        res = []
+        for i in np.argsort(-scores, kind="stable")[offset : offset + limit]:
+            hit = {**hits[i], "distance": float(scores[i])}
+            if not keep_vector:
+                hit["entity"] = {
+                    k: v for k, v in hit["entity"].items() if k != feature
+                }
+            res.append(hit)
+        return res
+
+    def get_vector_dtype(self, feature="clip"):
+        return self._vector_dtypes.get(feature, np.float32)
+
+    def get_nlist(self, feature="clip"):
+        for index in GlobalConfig.get("milvus", "indices") or []:
+            if index.get("field_name") == feature:
+                return (index.get("params") or {}).get("nlist")
+        return None
+
+    def has_field(self, field):
+        return field in self._fields
+
     def get_total(self):
         stats = self._client.get_collection_stats(self._collection_name)
         return stats["row_count"]
@@ -0,0 +1,152 @@
+import os
+import unicodedata
+from collections import defaultdict
+from math import ceil
+
+import numpy as np
+
+NGRAM = 3
+OCR_INDEX_DIR = "ocr_index"
+
+
+def ocr_index_path(work_dir, collection_name):
+    return work_dir / OCR_INDEX_DIR / f"{collection_name}.npz"
+
+
+def fold_text(text):
+    # Vietnamese OCR often drops or confuses tone marks, so both the index
+    # and the queries are matched without diacritics
+    text = unicodedata.normalize("NFD", text.lower()).replace("đ", "d")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.split())
+
+
+def ngrams(text):
+    return {text[i : i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+class OCRIndex(object):
+    # Inverted index from character n-grams of folded OCR lines to line ids.
+    # Lines of one frame are contiguous, so line_offsets maps a frame row to
+    # its lines and line_owners maps a line back to its frame row.
+    def __init__(
+        self, frame_ids, line_offsets, lines, grams, gram_offsets, postings
+    ):
+        self.frame_ids = frame_ids
+        self.line_offsets = line_offsets
+        self.lines = lines
+        self.grams = grams
+        self.gram_offsets = gram_offsets
+        self.postings = postings
+
+        self.line_owners = np.repeat(
+            np.arange(len(frame_ids), dtype=np.int64), np.diff(line_offsets)
+        )
+        self._gram_rows = {gram: i for i, gram in enumerate(grams.tolist())}
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+    @classmethod
+    def build(cls, entries):
+        frame_ids = []
+        line_offsets = [0]
+        lines = []
+        postings = defaultdict(list)
+        for frame_id, texts in sorted(entries):
+            texts = [x for x in map(fold_text, texts) if len(x) > 0]
+            if len(texts) == 0:
+                continue
+            frame_ids.append(frame_id)
+            for text in texts:
+                for gram in ngrams(text):
+                    postings[gram].append(len(lines))
+                lines.append(text)
+            line_offsets.append(len(lines))
+
+        grams = sorted(postings.keys())
+        gram_offsets = np.zeros(len(grams) + 1, dtype=np.int64)
+        np.cumsum([len(postings[x]) for x in grams], out=gram_offsets[1:])
+        return cls(
+            np.array(frame_ids, dtype=str),
+            np.array(line_offsets, dtype=np.int64),
+            np.array(lines, dtype=str),
+            np.array(grams, dtype=str),
+            gram_offsets,
+            np.array(
+                [line for gram in grams for line in postings[gram]],
+                dtype=np.int32,
+            ),
+        )
+
+    def candidates(self, queries, min_overlap=0.5):
+        # Frames with a line sharing at least min_overlap of the n-grams of
+        # one of the queries. Queries shorter than an n-gram fall back to a
+        # substring scan.
+        rows = []
+        for query in map(fold_text, queries):
+            if len(query) < NGRAM:
+                matched = np.flatnonzero(np.char.find(self.lines, query) >= 0)
+                rows.append(self.line_owners[matched])
+                continue
+
+            gram_rows = [
+                self._gram_rows[x]
+                for x in ngrams(query)
+                if x in self._gram_rows
+            ]
+            need = max(1, ceil(len(ngrams(query)) * min_overlap))
+            if len(gram_rows) < need:
+                continue
+            counts = np.bincount(
+                np.concatenate(
+                    [
+                        self.postings[
+                            self.gram_offsets[i] : self.gram_offsets[i + 1]
+                        ]
+                        for i in gram_rows
+                    ]
+                ),
+                minlength=len(self.lines),
+            )
+            rows.append(self.line_owners[counts >= need])
+        if len(rows) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(rows))
+
+    def get_lines(self, row):
+        return self.lines[
+            self.line_offsets[row] : self.line_offsets[row + 1]
+        ].tolist()
+
+    def entries(self):
+        # Lines are already folded, and folding them again is a no-op
+        for row, frame_id in enumerate(self.frame_ids.tolist()):
+            yield frame_id, self.get_lines(row)
+
+    def save(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                frame_ids=self.frame_ids,
+                line_offsets=self.line_offsets,
+                lines=self.lines,
+                grams=self.grams,
+                gram_offsets=self.gram_offsets,
+                postings=self.postings,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(
+            data["frame_ids"],
+            data["line_offsets"],
+            data["lines"],
+            data["grams"],
+            data["gram_offsets"],
+            data["postings"],
+        )
@@ -0,0 +1,53 @@
+import numpy as np
+
+ENCODE_CHUNK = 65536
+
+
+class SQ8Codes(object):
+    # Per-dimension 8-bit scalar quantization. Indexing returns dequantized
+    # float32 rows, so it can stand in for a vector matrix when scanning.
+    def __init__(self, codes, minimum, scale):
+        self.codes = codes
+        self.minimum = minimum
+        self.scale = scale
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, idx):
+        return self.codes[idx].astype(np.float32) * self.scale + self.minimum
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @classmethod
+    def train(cls, vectors):
+        minimum = np.full(vectors.shape[1], np.inf, dtype=np.float32)
+        maximum = np.full(vectors.shape[1], -np.inf, dtype=np.float32)
+        for start in range(0, len(vectors), ENCODE_CHUNK):
+            chunk = np.asarray(
+                vectors[start : start + ENCODE_CHUNK], dtype=np.float32
+            )
+            minimum = np.minimum(minimum, chunk.min(axis=0))
+            maximum = np.maximum(maximum, chunk.max(axis=0))
+        scale = (maximum - minimum) / 255
+        scale[scale == 0] = 1
+
+        codes = np.empty(vectors.shape, dtype=np.uint8)
+        for start in range(0, len(vectors), ENCODE_CHUNK):
+            chunk = np.asarray(
+                vectors[start : start + ENCODE_CHUNK], dtype=np.float32
+            )
+            codes[start : start + len(chunk)] = np.clip(
+                np.rint((chunk - minimum) / scale), 0, 255
+            )
+        return cls(codes, minimum, scale)
+
+    def save(self, path):
+        np.savez(path, codes=self.codes, minimum=self.minimum, scale=self.scale)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["codes"], data["minimum"], data["scale"])
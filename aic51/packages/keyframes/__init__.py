@@ -0,0 +1,12 @@
+from .selector import KeyframeSelector, CodecSelector, ShotSelector
+
+SELECTORS = {
+    "codec": CodecSelector,
+    "shot": ShotSelector,
+}
+
+
+def get_selector_cls(name):
+    if name not in SELECTORS:
+        raise ValueError(f"{name}: keyframe selector is not available")
+    return SELECTORS[name]
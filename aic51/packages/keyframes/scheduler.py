@@ -0,0 +1,270 @@
+import time
+import threading
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import cv2
+
+DECODE_REPORT_INTERVAL = 250
+
+
+def open_video(video_path, hw_decode=False):
+    if hw_decode:
+        # Falls back to software decoding when no accelerator is available
+        return cv2.VideoCapture(
+            str(video_path),
+            cv2.CAP_ANY,
+            [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY],
+        )
+    return cv2.VideoCapture(str(video_path))
+
+
+def _decode_worker(tasks, frames, events):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        video_id, video_path, selector, last_frame, keyframe_dir, hw_decode = (
+            task
+        )
+        cap = open_video(video_path, hw_decode)
+        try:
+            frame_counter = 0
+            selected = 0
+            while last_frame is None or frame_counter <= last_frame:
+                if not cap.grab():
+                    break
+                if selector.wants(frame_counter):
+                    ret, frame = cap.retrieve()
+                    if not ret:
+                        break
+                    if selector.accept(frame_counter, frame):
+                        frames.put(
+                            (
+                                video_id,
+                                f"{keyframe_dir}/{frame_counter:06d}.jpg",
+                                frame,
+                            )
+                        )
+                        selected += 1
+                frame_counter += 1
+                if frame_counter % DECODE_REPORT_INTERVAL == 0:
+                    events.put(("decoded", video_id, DECODE_REPORT_INTERVAL))
+            events.put(
+                ("decoded", video_id, frame_counter % DECODE_REPORT_INTERVAL)
+            )
+            events.put(("selected", video_id, selected))
+        except Exception as e:
+            events.put(("error", video_id, f"decode: {e}"))
+        finally:
+            cap.release()
+
+
+def _write_worker(frames, events, quality):
+    while True:
+        item = frames.get()
+        if item is None:
+            break
+        video_id, path, frame = item
+        try:
+            ret, data = cv2.imencode(
+                ".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality]
+            )
+            if not ret:
+                raise RuntimeError(f"{path}: could not encode frame")
+            with open(path, "wb") as f:
+                f.write(data.tobytes())
+            events.put(("written", video_id, len(data)))
+        except Exception as e:
+            events.put(("error", video_id, f"write: {e}"))
+
+
+class StageStats(object):
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.count = 0
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+
+    def add(self, count=1, size=0):
+        now = time.monotonic()
+        if self.started is None:
+            self.started = now
+        self.finished = now
+        self.count += count
+        self.bytes += size
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return self.finished - self.started
+
+    @property
+    def throughput(self):
+        return self.count / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class IngestScheduler(object):
+    # Three stages connected by bounded queues:
+    # - prepare: threads in this process copy videos and run the selector's
+    #   start() (ffprobe), which mostly waits on subprocesses and disks
+    # - decode: processes that decode each video once and pick its frames
+    # - write: processes that JPEG-encode and save the picked frames
+    # A full queue blocks the stage feeding it, so memory stays bounded
+    # whichever stage is the bottleneck.
+    def __init__(
+        self,
+        prepare_workers=2,
+        decode_workers=1,
+        write_workers=1,
+        queue_size=4,
+        frame_queue_size=64,
+        quality=50,
+        hw_decode=False,
+    ):
+        self._prepare_workers = max(1, prepare_workers)
+        self._decode_workers = max(1, decode_workers)
+        self._write_workers = max(1, write_workers)
+        self._queue_size = queue_size
+        self._frame_queue_size = frame_queue_size
+        self._quality = quality
+        self._hw_decode = hw_decode
+
+        self.stages = {
+            "prepare": StageStats("prepare", "videos"),
+            "decode": StageStats("decode", "frames"),
+            "write": StageStats("write", "keyframes"),
+        }
+        self.errors = {}
+
+    def run(self, video_paths, prepare, on_event=None):
+        # prepare(video_path) returns (video_id, path to decode, keyframe_dir,
+        # selector, last_frame); a keyframe_dir of None skips the video
+        ctx = mp.get_context("spawn")
+        tasks = ctx.Queue(self._queue_size)
+        frames = ctx.Queue(self._frame_queue_size)
+        events = ctx.Queue()
+
+        decoders = [
+            ctx.Process(
+                target=_decode_worker, args=(tasks, frames, events), daemon=True
+            )
+            for _ in range(self._decode_workers)
+        ]
+        writers = [
+            ctx.Process(
+                target=_write_worker,
+                args=(frames, events, self._quality),
+                daemon=True,
+            )
+            for _ in range(self._write_workers)
+        ]
+        for process in decoders + writers:
+            process.start()
+
+        feeder = threading.Thread(
+            target=self._feed,
+            args=(
+                video_paths,
+                prepare,
+                tasks,
+                frames,
+                events,
+                decoders,
+                writers,
+            ),
+            daemon=True,
+        )
+        feeder.start()
+
+        # Videos finish once decoding is done and all their frames are written
+        selected = {}
+        written = {}
+        while True:
+            kind, video_id, value = events.get()
+            if kind == "finished":
+                break
+            if kind == "prepared":
+                self.stages["prepare"].add()
+            elif kind == "decoded":
+                self.stages["decode"].add(value)
+            elif kind == "written":
+                self.stages["write"].add(1, value)
+                written[video_id] = written.get(video_id, 0) + 1
+            elif kind == "selected":
+                selected[video_id] = value
+            elif kind == "error":
+                self.errors.setdefault(video_id, value)
+
+            if on_event is not None:
+                on_event(kind, video_id, value)
+            if (
+                video_id in selected
+                and written.get(video_id, 0) >= selected[video_id]
+            ):
+                del selected[video_id]
+                if on_event is not None:
+                    on_event("done", video_id, video_id not in self.errors)
+
+        feeder.join()
+        return len(self.errors) == 0
+
+    def _feed(
+        self, video_paths, prepare, tasks, frames, events, decoders, writers
+    ):
+        try:
+            with ThreadPoolExecutor(self._prepare_workers) as executor:
+                futures = {
+                    executor.submit(prepare, path): path for path in video_paths
+                }
+                for future in as_completed(futures):
+                    path = futures[future]
+                    try:
+                        (
+                            video_id,
+                            decode_path,
+                            keyframe_dir,
+                            selector,
+                            last_frame,
+                        ) = future.result()
+                    except Exception as e:
+                        events.put(("error", path.stem, f"prepare: {e}"))
+                        events.put(("skipped", path.stem, False))
+                        continue
+
+                    events.put(("prepared", video_id, keyframe_dir is not None))
+                    if keyframe_dir is None:
+                        events.put(("skipped", video_id, True))
+                        continue
+                    tasks.put(
+                        (
+                            video_id,
+                            str(decode_path),
+                            selector,
+                            last_frame,
+                            str(keyframe_dir),
+                            self._hw_decode,
+                        )
+                    )
+        finally:
+            for _ in decoders:
+                tasks.put(None)
+            for process in decoders:
+                process.join()
+            for _ in writers:
+                frames.put(None)
+            for process in writers:
+                process.join()
+            for process in decoders + writers:
+                if process.exitcode not in [0, None]:
+                    events.put(
+                        (
+                            "error",
+                            process.name,
+                            f"worker exited with code {process.exitcode}",
+                        )
+                    )
+            events.put(("finished", None, None))
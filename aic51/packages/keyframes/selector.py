@@ -0,0 +1,161 @@
+import subprocess
+from abc import ABC, abstractmethod
+from collections import deque
+
+import cv2
+import numpy as np
+
+
+class KeyframeSelector(ABC):
+    # Decides which frames of a video are saved while it is decoded once.
+    # start() is called before decoding and returns the index of the last
+    # frame that has to be read (None for the whole video). Frames for which
+    # wants() is False are only grabbed; the others are decoded and passed
+    # to accept(), which returns whether to save them.
+    @abstractmethod
+    def start(self, video_path, num_frames=None):
+        pass
+
+    def wants(self, frame_idx):
+        return True
+
+    def accept(self, frame_idx, frame):
+        return True
+
+
+def probe_keyframes(video_path):
+    # Packet flags mark keyframes without decoding anything. Packets come in
+    # decode order, so they are sorted by pts to get frame numbers.
+    ffprobe_cmd = (
+        ["ffprobe", "-v", "quiet"]
+        + [
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "packet=pts,dts,flags",
+        ]
+        + ["-of", "csv=p=0", str(video_path)]
+    )
+    res = subprocess.run(ffprobe_cmd, capture_output=True, text=True)
+    packets = []
+    for line in res.stdout.strip().split("\n"):
+        fields = line.strip().split(",")
+        if len(fields) < 3:
+            continue
+        pts, dts, flags = fields[:3]
+        timestamp = pts if pts.lstrip("-").isdigit() else dts
+        if not timestamp.lstrip("-").isdigit():
+            continue
+        packets.append((int(timestamp), "K" in flags))
+    packets.sort()
+    keyframes = set([i for i, (_, key) in enumerate(packets) if key])
+    return keyframes, len(packets)
+
+
+class CodecSelector(KeyframeSelector):
+    # Codec keyframes, plus a frame every max_scene_length frames
+    def __init__(self, max_scene_length=25):
+        self._max_scene_length = max_scene_length
+        self._selected = set()
+
+    def start(self, video_path, num_frames=None):
+        keyframes, num_packets = probe_keyframes(video_path)
+        num_frames = num_packets or num_frames or 0
+
+        self._selected = set()
+        scene_length = 0
+        for frame_idx in range(num_frames):
+            if scene_length >= self._max_scene_length or frame_idx in keyframes:
+                self._selected.add(frame_idx)
+                scene_length = 0
+            scene_length += 1
+        return max(self._selected, default=-1)
+
+    def wants(self, frame_idx):
+        return frame_idx in self._selected
+
+
+def frame_histogram(small):
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([hsv], [0, 1], None, [16, 8], [0, 180, 0, 256])
+    return cv2.normalize(hist, hist).flatten()
+
+
+def frame_hash(small):
+    # 64-bit difference hash
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    gray = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (gray[:, 1:] > gray[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class ShotSelector(KeyframeSelector):
+    # Streaming shot-boundary detector. Every stride-th frame is downscaled
+    # and its colour histogram compared with the previous sampled frame; a
+    # Bhattacharyya distance above threshold starts a new shot, whose first
+    # frame is saved. Long shots still get a frame every max_scene_length
+    # frames. Candidates that look like one of the last history saved
+    # frames (perceptual hash within hash_distance bits and a similar
+    # histogram) are dropped as near duplicates, e.g. an anchor shot the
+    # news keeps cutting back to.
+    def __init__(
+        self,
+        threshold=0.35,
+        min_scene_length=10,
+        max_scene_length=250,
+        stride=2,
+        hash_distance=6,
+        history=16,
+    ):
+        self._threshold = threshold
+        self._min_scene_length = min_scene_length
+        self._max_scene_length = max_scene_length
+        self._stride = max(1, stride)
+        self._hash_distance = hash_distance
+        self._history = history
+
+    def start(self, video_path, num_frames=None):
+        self._prev_hist = None
+        self._last_saved = None
+        self._cut = False
+        self._history_frames = deque(maxlen=self._history)
+        return None
+
+    def wants(self, frame_idx):
+        return frame_idx % self._stride == 0
+
+    def accept(self, frame_idx, frame):
+        small = cv2.resize(frame, (64, 36), interpolation=cv2.INTER_AREA)
+        hist = frame_histogram(small)
+        prev_hist, self._prev_hist = self._prev_hist, hist
+
+        if self._last_saved is None:
+            return self._save(frame_idx, small, hist)
+
+        # A cut inside min_scene_length is remembered and saved once the
+        # scene is long enough
+        distance = cv2.compareHist(prev_hist, hist, cv2.HISTCMP_BHATTACHARYYA)
+        self._cut = self._cut or distance > self._threshold
+        scene_length = frame_idx - self._last_saved
+        if scene_length >= self._max_scene_length:
+            return self._save(frame_idx, small, hist)
+        if scene_length < self._min_scene_length or not self._cut:
+            return False
+        return self._save(frame_idx, small, hist)
+
+    def _save(self, frame_idx, small, hist):
+        # The scene restarts even when the frame is dropped as a duplicate,
+        # so a repeated shot is not re-sampled on every following frame
+        self._last_saved = frame_idx
+        self._cut = False
+        h = frame_hash(small)
+        # The hash only sees luminance structure, so colours are compared too
+        for x, x_hist in self._history_frames:
+            if (
+                bin(h ^ x).count("1") <= self._hash_distance
+                and cv2.compareHist(x_hist, hist, cv2.HISTCMP_BHATTACHARYYA)
+                <= self._threshold
+            ):
+                return False
+        self._history_frames.append((h, hist))
+        return True
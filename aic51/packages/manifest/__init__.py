@@ -0,0 +1 @@
+from .manifest import Manifest, MANIFEST_FILE, fingerprint, combine_hashes
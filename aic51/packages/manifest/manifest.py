@@ -0,0 +1,283 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+from ..store import FeatureStore
+
+MANIFEST_FILE = ".manifest.sqlite"
+FINGERPRINT_CHUNK = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    video_id TEXT PRIMARY KEY,
+    fingerprint TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS frames (
+    video_id TEXT,
+    frame_id TEXT,
+    PRIMARY KEY (video_id, frame_id)
+);
+CREATE TABLE IF NOT EXISTS stages (
+    video_id TEXT,
+    stage TEXT,
+    status TEXT,
+    input_hash TEXT,
+    output_hash TEXT,
+    updated REAL,
+    PRIMARY KEY (video_id, stage)
+);
+CREATE TABLE IF NOT EXISTS frame_stages (
+    video_id TEXT,
+    frame_id TEXT,
+    stage TEXT,
+    PRIMARY KEY (video_id, stage, frame_id)
+);
+"""
+
+
+def fingerprint(path):
+    # Size plus a hash of the head, middle and tail of the file, so large
+    # videos are identified without reading them whole
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(str(size).encode("utf-8"), digest_size=16)
+    with open(path, "rb") as f:
+        for offset in [0, size // 2, max(size - FINGERPRINT_CHUNK, 0)]:
+            f.seek(offset)
+            digest.update(f.read(FINGERPRINT_CHUNK))
+    return digest.hexdigest()
+
+
+def combine_hashes(*values):
+    digest = hashlib.blake2b(digest_size=16)
+    for value in values:
+        digest.update(str(value).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    # Per-video and per-frame stage status of the work directory, so add,
+    # analyse and index only redo work whose inputs changed. A stage left as
+    # "running" by a crash is simply not done and is redone on the next run.
+    def __init__(self, work_dir):
+        self._path = work_dir / MANIFEST_FILE
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            self._path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _transaction(self, statements):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    if isinstance(params, list):
+                        self._conn.executemany(sql, params)
+                    else:
+                        self._conn.execute(sql, params)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def has_video(self, video_id):
+        return (
+            len(
+                self._execute(
+                    "SELECT 1 FROM videos WHERE video_id = ?", (video_id,)
+                )
+            )
+            > 0
+        )
+
+    def get_fingerprint(self, video_id):
+        rows = self._execute(
+            "SELECT fingerprint FROM videos WHERE video_id = ?", (video_id,)
+        )
+        return rows[0][0] if len(rows) > 0 else None
+
+    def set_frames(self, video_id, video_fingerprint, frame_ids):
+        # New keyframes invalidate everything computed from the old ones
+        frame_ids = sorted(frame_ids)
+        self._transaction(
+            [
+                ("DELETE FROM frames WHERE video_id = ?", (video_id,)),
+                ("DELETE FROM frame_stages WHERE video_id = ?", (video_id,)),
+                ("DELETE FROM stages WHERE video_id = ?", (video_id,)),
+                (
+                    "INSERT OR REPLACE INTO videos VALUES (?, ?, ?)",
+                    (video_id, video_fingerprint, time.time()),
+                ),
+                (
+                    "INSERT INTO frames VALUES (?, ?)",
+                    [(video_id, x) for x in frame_ids],
+                ),
+                (
+                    "INSERT INTO stages VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        video_id,
+                        "keyframes",
+                        "done",
+                        video_fingerprint,
+                        combine_hashes(video_fingerprint, *frame_ids),
+                        time.time(),
+                    ),
+                ),
+            ]
+        )
+
+    def adopt(self, work_dir, video_id):
+        # Registers keyframes and features written before the work directory
+        # had a manifest, so they are not extracted and analysed again.
+        # Videos the manifest saw being extracted are left alone, even if
+        # they were interrupted.
+        if self.get_stage(video_id, "keyframes") is not None:
+            return False
+        video_path = work_dir / "videos" / f"{video_id}.mp4"
+        frame_ids = [
+            x.stem for x in (work_dir / "keyframes" / video_id).glob("*.jpg")
+        ]
+        if len(frame_ids) == 0:
+            return False
+        self.set_frames(
+            video_id,
+            fingerprint(video_path) if video_path.exists() else None,
+            frame_ids,
+        )
+
+        keyframes_hash = self.get_stage(video_id, "keyframes")["output_hash"]
+        store = FeatureStore(work_dir / "features")
+        analysed = {}
+        for model_name in store.models(video_id):
+            analysed[model_name] = sorted(
+                set(store.frame_ids(video_id, model_name)) & set(frame_ids)
+            )
+        for model_name, done in analysed.items():
+            stage = f"features:{model_name}"
+            self.mark_frames(video_id, stage, done)
+            self.finish_stage(
+                video_id,
+                stage,
+                keyframes_hash,
+                combine_hashes(keyframes_hash, stage, *done),
+            )
+        return True
+
+    def scan(self, work_dir):
+        # Lists the videos with extracted keyframes, adopting older ones
+        for d in (work_dir / "keyframes").glob("*"):
+            if d.is_dir():
+                self.adopt(work_dir, d.stem)
+        return self.get_videos()
+
+    def get_frames(self, video_id):
+        if not self.has_video(video_id):
+            return None
+        return [
+            x[0]
+            for x in self._execute(
+                "SELECT frame_id FROM frames WHERE video_id = ? "
+                "ORDER BY frame_id",
+                (video_id,),
+            )
+        ]
+
+    def get_videos(self):
+        return [
+            x[0]
+            for x in self._execute(
+                "SELECT video_id FROM stages "
+                "WHERE stage = 'keyframes' AND status = 'done' "
+                "ORDER BY video_id"
+            )
+        ]
+
+    def get_done_frames(self, video_id, stage):
+        return set(
+            x[0]
+            for x in self._execute(
+                "SELECT frame_id FROM frame_stages "
+                "WHERE video_id = ? AND stage = ?",
+                (video_id, stage),
+            )
+        )
+
+    def mark_frames(self, video_id, stage, frame_ids):
+        self._transaction(
+            [
+                (
+                    "INSERT OR IGNORE INTO frame_stages VALUES (?, ?, ?)",
+                    [(video_id, x, stage) for x in frame_ids],
+                )
+            ]
+        )
+
+    def start_stage(self, video_id, stage, input_hash=None):
+        self._execute(
+            "INSERT OR REPLACE INTO stages VALUES (?, ?, 'running', ?, NULL, ?)",
+            (video_id, stage, input_hash, time.time()),
+        )
+
+    def finish_stage(self, video_id, stage, input_hash=None, output_hash=None):
+        self._execute(
+            "INSERT OR REPLACE INTO stages VALUES (?, ?, 'done', ?, ?, ?)",
+            (video_id, stage, input_hash, output_hash, time.time()),
+        )
+
+    def fail_stage(self, video_id, stage):
+        self._execute(
+            "UPDATE stages SET status = 'failed', updated = ? "
+            "WHERE video_id = ? AND stage = ?",
+            (time.time(), video_id, stage),
+        )
+
+    def get_stage(self, video_id, stage):
+        rows = self._execute(
+            "SELECT status, input_hash, output_hash FROM stages "
+            "WHERE video_id = ? AND stage = ?",
+            (video_id, stage),
+        )
+        if len(rows) == 0:
+            return None
+        status, input_hash, output_hash = rows[0]
+        return dict(
+            status=status, input_hash=input_hash, output_hash=output_hash
+        )
+
+    def is_done(self, video_id, stage, input_hash=None):
+        info = self.get_stage(video_id, stage)
+        return (
+            info is not None
+            and info["status"] == "done"
+            and (input_hash is None or info["input_hash"] == input_hash)
+        )
+
+    def get_output_hashes(self, video_id, prefix):
+        return self._execute(
+            "SELECT stage, output_hash FROM stages "
+            "WHERE video_id = ? AND stage LIKE ? AND status = 'done' "
+            "ORDER BY stage",
+            (video_id, f"{prefix}%"),
+        )
+
+    def reset_stage(self, stage):
+        self._transaction(
+            [
+                ("DELETE FROM stages WHERE stage = ?", (stage,)),
+                ("DELETE FROM frame_stages WHERE stage = ?", (stage,)),
+            ]
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
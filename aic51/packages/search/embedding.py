@@ -0,0 +1,148 @@
+import os
+import logging
+import threading
+import multiprocessing as mp
+from multiprocessing.connection import Client, Listener
+
+import torch
+
+from ..analyse.features import TextEncoder, create_text_encoder
+
+ADDRESS_ENV = "AIC51_EMBEDDING_ADDRESS"
+AUTHKEY_ENV = "AIC51_EMBEDDING_AUTHKEY"
+
+
+def _serve(model_infos, dtype, text_batching, ready):
+    # Runs in the sidecar: every connection (one per searching thread of a
+    # uvicorn worker) gets a thread, and the micro-batcher merges their
+    # queries into shared batches
+    encoders = {}
+    for model_info in model_infos:
+        encoder = create_text_encoder(model_info, dtype)
+        if text_batching is not None:
+            encoder.enable_text_batching(**text_batching)
+        encoders[model_info["name"].lower()] = encoder
+
+    authkey = os.urandom(32)
+    with Listener(("127.0.0.1", 0), authkey=authkey) as listener:
+        ready.send((listener.address, authkey))
+        ready.close()
+        while True:
+            try:
+                conn = listener.accept()
+            except mp.AuthenticationError:
+                continue
+            threading.Thread(
+                target=_handle, args=(encoders, conn), daemon=True
+            ).start()
+
+
+def _handle(encoders, conn):
+    with conn:
+        while True:
+            try:
+                model_name, texts = conn.recv()
+            except EOFError:
+                return
+            try:
+                features = encoders[model_name].get_text_features(texts)
+                conn.send(("ok", features.numpy()))
+            except Exception as e:
+                conn.send(("error", f"{type(e).__name__}: {str(e)}"))
+
+
+class EmbeddingSidecar(object):
+    # A single process holding the text encoders for all uvicorn workers,
+    # so their weights are loaded once rather than once per worker. Workers
+    # find it through environment variables, which they inherit.
+    def __init__(self, model_infos, dtype="float32", text_batching=None):
+        self._logger = logging.getLogger(
+            f'{".".join(__name__.split(".")[:-1])}.{self.__class__.__name__}'
+        )
+        self._model_infos = model_infos
+        self._dtype = dtype
+        self._text_batching = text_batching
+        self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        context = mp.get_context("spawn")
+        receiver, sender = context.Pipe(duplex=False)
+        self._process = context.Process(
+            target=_serve,
+            args=(self._model_infos, self._dtype, self._text_batching, sender),
+            daemon=True,
+        )
+        self._process.start()
+        sender.close()
+        try:
+            (host, port), authkey = receiver.recv()
+        except EOFError:
+            raise RuntimeError("Embedding sidecar exited while loading models")
+        finally:
+            receiver.close()
+
+        os.environ[ADDRESS_ENV] = f"{host}:{port}"
+        os.environ[AUTHKEY_ENV] = authkey.hex()
+        self._logger.info(f"Embedding sidecar listening on {host}:{port}")
+
+    def stop(self):
+        os.environ.pop(ADDRESS_ENV, None)
+        os.environ.pop(AUTHKEY_ENV, None)
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+
+def get_sidecar_address():
+    address = os.getenv(ADDRESS_ENV)
+    if address is None:
+        return None
+    host, port = address.rsplit(":", 1)
+    return (host, int(port)), bytes.fromhex(os.environ[AUTHKEY_ENV])
+
+
+class RemoteTextEncoder(TextEncoder):
+    # Same interface and local text cache as TextEncoder, but queries that
+    # miss the cache are embedded by the sidecar. Connections are not
+    # thread-safe, so each thread keeps its own.
+    def __init__(self, pretrained_model, model_name, address, authkey):
+        self._pretrained_model = pretrained_model
+        self._model_name = model_name
+        self._address = address
+        self._authkey = authkey
+        self._local = threading.local()
+        self._text_cache = None
+        self._text_batcher = None
+
+    def enable_text_batching(self, max_batch_size=32, max_wait_ms=5):
+        # Batching happens in the sidecar, across all workers
+        pass
+
+    def _encode_texts(self, texts):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = Client(self._address, authkey=self._authkey)
+            self._local.conn = conn
+        try:
+            conn.send((self._model_name, texts))
+            status, result = conn.recv()
+        except (EOFError, OSError):
+            # Reconnect on the next query
+            self._local.conn = None
+            conn.close()
+            raise
+        if status != "ok":
+            raise RuntimeError(f"Embedding sidecar failed: {result}")
+        # Views would keep the whole reply alive in the text cache
+        return [torch.from_numpy(x.copy()) for x in result]
+
+    def to(self, device):
+        pass
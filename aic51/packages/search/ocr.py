@@ -0,0 +1,103 @@
+from collections import defaultdict
+
+import numpy as np
+from rapidfuzz import fuzz, process
+
+
+class OCRTexts(object):
+    # Unique lower-cased OCR lines of a result list, plus the flattened
+    # (record, line) layout needed to reduce line scores back per record.
+    def __init__(self, line_lists):
+        columns = {}
+        self.texts = []
+        self.columns = []
+        self.owners = []
+        self.num_records = len(line_lists)
+        for i, lines in enumerate(line_lists):
+            for text in lines:
+                text = text.lower()
+                column = columns.get(text)
+                if column is None:
+                    column = columns[text] = len(self.texts)
+                    self.texts.append(text)
+                self.columns.append(column)
+                self.owners.append(i)
+        self.columns = np.array(self.columns, dtype=np.int64)
+        self.owners = np.array(self.owners, dtype=np.int64)
+
+        # Texts sharing no character with a query score 0, so they only
+        # need to be scored when 0 can pass the threshold
+        self._char_index = defaultdict(list)
+        for column, text in enumerate(self.texts):
+            for c in set(text):
+                self._char_index[c].append(column)
+
+    def candidates(self, query):
+        if len(query) == 0:
+            return np.arange(len(self.texts))
+        columns = set()
+        for c in set(query):
+            columns.update(self._char_index.get(c, []))
+        return np.array(sorted(columns), dtype=np.int64)
+
+
+def partial_ratios(queries, ocr_texts, threshold):
+    # Same integer scores as thefuzz.fuzz.partial_ratio, computed once per
+    # unique (query, text) pair
+    scores = np.zeros((len(queries), len(ocr_texts.texts)), dtype=np.float64)
+    if len(ocr_texts.texts) == 0:
+        return scores
+    for i, query in enumerate(queries):
+        if threshold < 0:
+            columns = np.arange(len(ocr_texts.texts))
+        else:
+            columns = ocr_texts.candidates(query)
+        if len(columns) == 0:
+            continue
+        texts = [ocr_texts.texts[c] for c in columns]
+        scores[i, columns] = np.round(
+            process.cdist(
+                [query],
+                texts,
+                scorer=fuzz.partial_ratio,
+                dtype=np.float64,
+                workers=-1,
+            )[0]
+        )
+    return scores
+
+
+def ocr_distances(queries, records, threshold):
+    return text_distances(
+        queries,
+        [[x[-2] for x in r["entity"].get("ocr") or []] for r in records],
+        threshold,
+    )
+
+
+def text_distances(queries, line_lists, threshold):
+    queries = [x.lower() for x in queries]
+    ocr_texts = OCRTexts(line_lists)
+    scores = partial_ratios(queries, ocr_texts, threshold)
+
+    distances = np.zeros(len(line_lists), dtype=np.float64)
+    for query_scores in scores:
+        line_scores = query_scores[ocr_texts.columns]
+        matched = line_scores > threshold
+        totals = np.bincount(
+            ocr_texts.owners[matched],
+            weights=line_scores[matched] / 100,
+            minlength=ocr_texts.num_records,
+        )
+        counts = np.bincount(
+            ocr_texts.owners[matched], minlength=ocr_texts.num_records
+        )
+        distances += np.divide(
+            totals,
+            counts,
+            out=np.zeros(ocr_texts.num_records),
+            where=counts > 0,
+        )
+    if len(queries) > 0:
+        distances /= len(queries)
+    return distances
@@ -0,0 +1,90 @@
+from collections import defaultdict
+
+import numpy as np
+
+
+def choose_anchor(probe_results):
+    # A clause whose best hits stand out from the rest of its probe is the
+    # one that narrows the search down the most
+    best_score = None
+    anchor = 0
+    for i, res in enumerate(probe_results):
+        if len(res) == 0:
+            return i
+        distances = np.array([x["distance"] for x in res])
+        score = distances[0] - distances.mean()
+        if best_score is None or score > best_score:
+            best_score = score
+            anchor = i
+    return anchor
+
+
+def candidate_windows(records, forward, max_interval, use_idx=False):
+    # Frame ranges (inclusive) where the neighbouring clause can still
+    # match one of the given records, merged per video. Videos are keyed by
+    # video_idx when the collection has the integer columns.
+    ranges = defaultdict(list)
+    for record in records:
+        if use_idx:
+            video_id = record["entity"]["video_idx"]
+            frame_id = record["entity"]["frame_idx"]
+        else:
+            video_id, frame_id = record["entity"]["frame_id"].split("#")
+            frame_id = int(frame_id)
+        if forward:
+            ranges[video_id].append((frame_id + 1, frame_id + max_interval))
+        else:
+            ranges[video_id].append(
+                (max(frame_id - max_interval, 0), frame_id - 1)
+            )
+
+    return {
+        video_id: merge_windows(windows) for video_id, windows in ranges.items()
+    }
+
+
+def merge_windows(windows, max_gap=0):
+    merged = []
+    for start, end in sorted(windows):
+        if end < start:
+            continue
+        if len(merged) > 0 and start <= merged[-1][1] + max_gap + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def windows_filter(windows, max_terms, use_idx=False):
+    # Coarsen the windows until the expression stays small enough, then
+    # fall back to whole videos
+    max_gap = 1
+    while sum(len(x) for x in windows.values()) > max_terms:
+        if max_gap > 1 << 16:
+            if len(windows) > max_terms:
+                return None
+            if use_idx:
+                return f"video_idx in [{', '.join(map(str, windows))}]"
+            return " || ".join(
+                [f'frame_id like "{video_id}#%"' for video_id in windows]
+            )
+        windows = {
+            video_id: merge_windows(x, max_gap)
+            for video_id, x in windows.items()
+        }
+        max_gap *= 2
+
+    terms = []
+    for video_id, video_windows in windows.items():
+        for start, end in video_windows:
+            if use_idx:
+                terms.append(
+                    f"(video_idx == {video_id}"
+                    f" && frame_idx >= {start} && frame_idx <= {end})"
+                )
+            else:
+                terms.append(
+                    f'(frame_id >= "{video_id}#{start:06d}"'
+                    f' && frame_id <= "{video_id}#{end:06d}")'
+                )
+    return " || ".join(terms)
@@ -1,28 +1,73 @@
 import re
 import time
-from copy import deepcopy
 import logging
 import hashlib
-
-from thefuzz import fuzz
-
-from ..index import MilvusDatabase
+from pathlib import Path
+
+import numpy as np
+
+from ..index import (
+    get_database_cls,
+    encode_video_id,
+    OCRIndex,
+    fold_text,
+    ocr_index_path,
+)
+from ..cache import INDEX_STAMP, create_cache
+from .temporal import frame_keys, encode_keys, decode_keys, temporal_join
+from .ocr import ocr_distances, text_distances
+from .planner import choose_anchor, candidate_windows, windows_filter
+from .embedding import RemoteTextEncoder, get_sidecar_address
 from ...config import GlobalConfig
-from ...packages.analyse.features import CLIP
+from ...packages.analyse.features import create_text_encoder
 
 
 class Searcher(object):
-    cache = {}
+    ID_BATCH_SIZE = 1000
 
-    def __init__(self, collection_name):
+    def __init__(self, collection_name, work_dir=None, database="milvus"):
         self._logger = logging.getLogger("searcher")
-        self._database = MilvusDatabase(collection_name)
+        self._collection_name = collection_name
+        work_dir = Path(work_dir) if work_dir is not None else Path.cwd()
+        self._database = get_database_cls(database)(
+            collection_name, work_dir=work_dir
+        )
+        self._frame_fields = self._database.has_field(
+            "video_idx"
+        ) and self._database.has_field("frame_idx")
+        self._work_dir = work_dir
+        self._ocr_config = GlobalConfig.get("webui", "ocr_index") or {}
+        self._ocr_index = None
+        self._ocr_index_mtime = None
+        self.cache = create_cache(
+            GlobalConfig.get("webui", "cache"), work_dir / INDEX_STAMP
+        )
+        self.text_cache = create_cache(
+            GlobalConfig.get("webui", "text_cache")
+            or {"policy": "lru", "max_bytes": 64 * 1024 * 1024}
+        )
+        text_batching = GlobalConfig.get("webui", "text_batching")
+        text_encoder = GlobalConfig.get("webui", "text_encoder") or {}
+        sidecar = get_sidecar_address()
+        self._planner = GlobalConfig.get("webui", "planner") or {}
         self._models = {}
         for model in GlobalConfig.get("webui", "features") or []:
             model_name = model["name"].lower()
             if model_name == "clip":
-                pretrained_model = model["pretrained_model"]
-                self._models[model_name] = CLIP(pretrained_model)
+                # Only the text tower is needed to embed queries
+                if sidecar is not None:
+                    self._models[model_name] = RemoteTextEncoder(
+                        model["pretrained_model"], model_name, *sidecar
+                    )
+                else:
+                    self._models[model_name] = create_text_encoder(
+                        model, text_encoder.get("dtype") or "float32"
+                    )
+                self._models[model_name].set_text_cache(self.text_cache)
+                if text_batching is not None:
+                    self._models[model_name].enable_text_batching(
+                        **text_batching
+                    )
 
         if len(self._models) == 0:
             self._logger.error(
@@ -30,11 +75,20 @@ class Searcher(object):
             )
 
     def get(self, id):
-        return self._database.get(id)
+        return self._database.get(id, ["frame_id"])
 
     def get_models(self):
         return list(self._models.keys())
 
+    def get_cache_stats(self):
+        return {
+            "results": self.cache.stats(),
+            "text": self.text_cache.stats(),
+        }
+
+    def _get_text_features(self, model, queries):
+        return self._models[model].get_text_features(queries).tolist()
+
     def _process_query(self, query):
         video_match = re.search('video:((".+?")|\\S+)\\s?', query)
         video_ids = (
@@ -75,108 +129,147 @@ class Searcher(object):
     ):
         if "ocr" not in advance_query:
             return result
-        query_ocr = advance_query["ocr"]
-        res = deepcopy(result)
-        for i, record in enumerate(result):
-            ocr_distance = 0
-            for query_text in query_ocr:
-                ocr = (
-                    record["entity"]["ocr"] if "ocr" in record["entity"] else []
-                )
-                ocr_text_distance = 0
-                cnt = 0
-                for text in ocr:
-                    partial_ratio = fuzz.partial_ratio(
-                        query_text.lower(), text[-2].lower()
-                    )
-                    if partial_ratio > ocr_threshold:
-                        cnt += 1
-                        ocr_text_distance += partial_ratio / 100
+        distances = (
+            np.array([x["distance"] for x in result], dtype=np.float64)
+            + ocr_distances(advance_query["ocr"], result, ocr_threshold)
+            * ocr_weight
+        ) / (1 + ocr_weight)
+        order = np.argsort(-distances, kind="stable")
+        res = [{**result[i], "distance": float(distances[i])} for i in order]
+        return res
 
-                if cnt > 0:
-                    ocr_text_distance /= cnt
-                ocr_distance += ocr_text_distance
+    def _get_ocr_index(self):
+        if not self._ocr_config.get("enabled", True):
+            return None
+        path = ocr_index_path(self._work_dir, self._collection_name)
+        try:
+            mtime = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            self._ocr_index = None
+            return None
+        if self._ocr_index is None or self._ocr_index_mtime != mtime:
+            self._ocr_index = OCRIndex.load(path)
+            self._ocr_index_mtime = mtime
+        return self._ocr_index
+
+    def _filter_frame_ids(self, frame_ids, filter):
+        allowed = set()
+        for start in range(0, len(frame_ids), self.ID_BATCH_SIZE):
+            batch = frame_ids[start : start + self.ID_BATCH_SIZE]
+            ids_filter = ", ".join([f'"{x}"' for x in batch])
+            records = self._database.query(
+                f"({filter}) && frame_id in [{ids_filter}]",
+                0,
+                len(batch),
+                ["frame_id"],
+            )
+            allowed.update([x["frame_id"] for x in records])
+        return allowed
 
-            if len(query_ocr) > 0:
-                ocr_distance /= len(query_ocr)
+    def _ocr_search(self, ocr_index, query_ocr, filter, limit, ocr_threshold):
+        rows = ocr_index.candidates(
+            query_ocr, self._ocr_config.get("min_overlap") or 0.5
+        )
+        distances = text_distances(
+            [fold_text(x) for x in query_ocr],
+            [ocr_index.get_lines(row) for row in rows],
+            ocr_threshold,
+        )
+        order = np.argsort(-distances, kind="stable")
+        order = order[distances[order] > 0]
+        frame_ids = ocr_index.frame_ids[rows[order]].tolist()
+        distances = distances[order].tolist()
+        if len(filter) > 0:
+            allowed = self._filter_frame_ids(frame_ids, filter)
+        else:
+            allowed = None
 
-            res[i]["distance"] = (
-                record["distance"] + ocr_distance * ocr_weight
-            ) / (1 + ocr_weight)
-        res = sorted(res, key=lambda x: x["distance"], reverse=True)
+        res = []
+        for frame_id, distance in zip(frame_ids, distances):
+            if allowed is not None and frame_id not in allowed:
+                continue
+            res.append(
+                {
+                    "id": frame_id,
+                    "distance": distance,
+                    "entity": {"frame_id": frame_id},
+                }
+            )
+            if len(res) >= limit:
+                break
         return res
 
+    def _merge_ocr_hits(
+        self,
+        ocr_index,
+        query_ocr,
+        result,
+        text_features,
+        filter,
+        model,
+        output_fields,
+        ocr_threshold,
+    ):
+        # Frames whose text matches but whose vector score left them out of
+        # the top results are scored exactly and added before re-ranking
+        hits = self._ocr_search(
+            ocr_index,
+            query_ocr,
+            filter,
+            self._ocr_config.get("max_candidates") or 256,
+            ocr_threshold,
+        )
+        seen = set([x["id"] for x in result])
+        missing = [x["id"] for x in hits if x["id"] not in seen]
+        if len(missing) == 0:
+            return result
+
+        ids_filter = ", ".join([f'"{x}"' for x in missing])
+        ids_filter = f"frame_id in [{ids_filter}]"
+        if len(filter) > 0:
+            ids_filter = f"({filter}) && {ids_filter}"
+        extra = self._database.search(
+            [text_features],
+            ids_filter,
+            0,
+            len(missing),
+            1,
+            model,
+            output_fields,
+            exact=True,
+        )[0]
+        return result + extra
+
     def _combine_temporal_results(self, results, temporal_k, max_interval):
-        best = None
-        for i in range(len(results)):
-            res = results[i]
-            for j in range(len(res)):
-                video_id, frame_id = results[i][j]["entity"]["frame_id"].split(
-                    "#"
-                )
-                video_id = video_id.replace("L", "").replace("_V", "")
-                video_id = int(video_id)
-                frame_id = int(frame_id)
-                results[i][j]["_id"] = (video_id, frame_id)
-
-        for res in results[::-1]:
-            if best is None:
-                best = res[:temporal_k]
-                continue
-            tmp = []
-            res = sorted(res, key=lambda x: x["_id"])
-            best = sorted(best, key=lambda x: x["_id"])
-            l = 0
-            r = 0
-            for cur in res:
-                cur_vid, cur_fid = cur["_id"]
-                cur_fid = int(cur_fid)
-
-                while l < len(best):
-                    next_vid, next_fid = best[l]["_id"]
-                    next_fid = int(next_fid)
-                    if next_vid > cur_vid or (
-                        next_vid == cur_vid and next_fid > cur_fid
-                    ):
-                        break
-                    else:
-                        l += 1
-
-                while r < len(best):
-                    next_vid, next_fid = best[r]["_id"]
-                    next_fid = int(next_fid)
-                    if next_vid > cur_vid or (
-                        next_vid == cur_vid
-                        and next_fid > cur_fid + max_interval
-                    ):
-                        break
-                    else:
-                        r += 1
-
-                for i in range(l, r):
-                    tmp.append(
-                        {
-                            **cur,
-                            "distance": cur["distance"] + best[i]["distance"],
-                        }
-                    )
-            highest = {}
-            for cur in tmp:
-                if (
-                    cur["_id"] not in highest
-                    or cur["distance"] > highest[cur["_id"]]["distance"]
-                ):
-                    highest[cur["_id"]] = cur
-            tmp = list(highest.values())
-            tmp = sorted(tmp, key=lambda x: x["distance"], reverse=True)
-            best = tmp[:temporal_k]
+        keys = []
+        scores = []
+        for res in results:
+            video_ids, frame_ids = frame_keys(res)
+            keys.append(encode_keys(video_ids, frame_ids))
+            scores.append(
+                np.array([x["distance"] for x in res], dtype=np.float64)
+            )
+
+        best_idx, best_scores = temporal_join(
+            keys, scores, temporal_k, max_interval
+        )
+
+        first = results[0]
+        video_ids, frame_ids = decode_keys(keys[0][best_idx])
+        best = []
+        for i, idx in enumerate(best_idx):
+            best.append(
+                {
+                    **first[idx],
+                    "_id": (int(video_ids[i]), int(frame_ids[i])),
+                    "distance": float(best_scores[i]),
+                }
+            )
 
         return best
 
     def _simple_search(self, processed, filter, offset, limit, nprobe, model):
-        text_features = (
-            self._models[model].get_text_features(processed["queries"]).tolist()
-        )
+        text_features = self._get_text_features(model, processed["queries"])
         filter = self._combine_videos_filter(filter, processed["video_ids"])
 
         results = self._database.search(
@@ -186,6 +279,7 @@ class Searcher(object):
             limit,
             nprobe,
             model,
+            ["frame_id"],
         )[0]
         res = {
             "results": results,
@@ -194,10 +288,21 @@ class Searcher(object):
         }
         return res
 
-    def _combine_videos_filter(self, filter, video_ids):
-        video_ids_fitler = " || ".join(
+    def _videos_filter(self, video_ids):
+        if self._frame_fields and len(video_ids) > 0:
+            try:
+                video_idxs = [
+                    str(encode_video_id(x.strip())) for x in video_ids
+                ]
+                return f"video_idx in [{', '.join(video_idxs)}]"
+            except ValueError:
+                pass
+        return " || ".join(
             [f'frame_id like "{x.strip()}#%"' for x in video_ids]
         )
+
+    def _combine_videos_filter(self, filter, video_ids):
+        video_ids_fitler = self._videos_filter(video_ids)
         filter_empty = len(filter) == 0
         if len(video_ids) > 0:
             video_ids_fitler = "(" + video_ids_fitler + ")"
@@ -232,28 +337,99 @@ class Searcher(object):
         query_hash = hashlib.sha256(
             (f"complex:{repr(processed)}{repr(params)}").encode("utf-8")
         ).hexdigest()
-        if query_hash in self.cache:
-            combined_results = self.cache[query_hash]
-        else:
+        combined_results = self.cache.get(query_hash)
+        if combined_results is None:
+            filter = self._combine_videos_filter(filter, processed["video_ids"])
+            output_fields = ["frame_id"]
+            if self._frame_fields:
+                output_fields += ["video_idx", "frame_idx"]
+            if any("ocr" in x for x in processed["advance"]):
+                output_fields.append("ocr")
+
+            # Clauses with only OCR terms are answered by the OCR index and
+            # need no text encoding
+            ocr_index = self._get_ocr_index()
+            ocr_only = [
+                ocr_index is not None and len(q) == 0 and "ocr" in advance
+                for q, advance in zip(
+                    processed["queries"], processed["advance"]
+                )
+            ]
+            vector_clauses = [i for i, x in enumerate(ocr_only) if not x]
             text_features = (
-                self._models[model]
-                .get_text_features(processed["queries"])
-                .tolist()
+                self._get_text_features(
+                    model, [processed["queries"][i] for i in vector_clauses]
+                )
+                if len(vector_clauses) > 0
+                else []
             )
-            filter = self._combine_videos_filter(filter, processed["video_ids"])
 
             st = time.time()
-            results = self._database.search(
-                text_features,
-                filter,
-                0,
-                temporal_k,
-                nprobe,
-                model,
-            )
+            results = [[] for _ in processed["queries"]]
+            if (
+                len(text_features) > 1
+                and not any(ocr_only)
+                and self._planner.get("enabled")
+            ):
+                results = self._planned_search(
+                    text_features,
+                    filter,
+                    temporal_k,
+                    nprobe,
+                    model,
+                    output_fields,
+                    max_interval,
+                )
+            elif len(text_features) > 0:
+                vector_results = self._database.search(
+                    text_features,
+                    filter,
+                    0,
+                    temporal_k,
+                    nprobe,
+                    model,
+                    output_fields,
+                )
+                for i, res in zip(vector_clauses, vector_results):
+                    results[i] = res
+
+            for i, advance in enumerate(processed["advance"]):
+                if ocr_index is None or "ocr" not in advance:
+                    continue
+                if ocr_only[i]:
+                    # Scaled like the OCR term of the blend in
+                    # _process_advance, so the clause weighs the same as
+                    # the vector clauses it is joined with. The CLIP term
+                    # of the empty query is left out.
+                    results[i] = [
+                        {
+                            **x,
+                            "distance": x["distance"]
+                            * ocr_weight
+                            / (1 + ocr_weight),
+                        }
+                        for x in self._ocr_search(
+                            ocr_index,
+                            advance["ocr"],
+                            filter,
+                            temporal_k,
+                            ocr_threshold,
+                        )
+                    ]
+                else:
+                    results[i] = self._merge_ocr_hits(
+                        ocr_index,
+                        advance["ocr"],
+                        results[i],
+                        text_features[vector_clauses.index(i)],
+                        filter,
+                        model,
+                        output_fields,
+                        ocr_threshold,
+                    )
             en = time.time()
             self._logger.debug(f"{en-st:.4f} seconds to search results")
-            for i in range(len(processed["queries"])):
+            for i in vector_clauses:
                 results[i] = self._process_advance(
                     processed["advance"][i],
                     results[i],
@@ -267,7 +443,7 @@ class Searcher(object):
             )
             en = time.time()
             self._logger.debug(f"{en-st:.4f} seconds to combine results")
-            self.cache[query_hash] = combined_results
+            self.cache.put(query_hash, combined_results)
         if combined_results is not None and offset < len(combined_results):
             results = combined_results[offset : offset + limit]
         else:
@@ -280,23 +456,94 @@ class Searcher(object):
         }
         return res
 
+    def _planned_search(
+        self,
+        text_features,
+        filter,
+        temporal_k,
+        nprobe,
+        model,
+        output_fields,
+        max_interval,
+    ):
+        probe = self._database.search(
+            text_features,
+            filter,
+            0,
+            self._planner.get("probe_k") or 100,
+            nprobe,
+            model,
+            ["frame_id"],
+        )
+        anchor = choose_anchor(probe)
+        self._logger.debug(f"Clause {anchor} is used as anchor")
+
+        results = [[] for _ in text_features]
+        results[anchor] = self._database.search(
+            [text_features[anchor]],
+            filter,
+            0,
+            temporal_k,
+            nprobe,
+            model,
+            output_fields,
+        )[0]
+
+        # Clauses are searched outwards from the anchor, each one only inside
+        # the frame windows its already searched neighbour leaves open
+        max_terms = self._planner.get("max_filter_terms") or 256
+        for order in [
+            range(anchor + 1, len(text_features)),
+            range(anchor - 1, -1, -1),
+        ]:
+            prev = anchor
+            for i in order:
+                windows = candidate_windows(
+                    results[prev], i > prev, max_interval, self._frame_fields
+                )
+                if len(windows) == 0:
+                    break
+
+                window_filter = windows_filter(
+                    windows, max_terms, self._frame_fields
+                )
+                if window_filter is None:
+                    window_filter = filter
+                    window_nprobe = nprobe
+                else:
+                    if len(filter) > 0:
+                        window_filter = f"{filter} && ({window_filter})"
+                    window_nprobe = self._planner.get("nprobe") or nprobe
+
+                results[i] = self._database.search(
+                    [text_features[i]],
+                    window_filter,
+                    0,
+                    temporal_k,
+                    window_nprobe,
+                    model,
+                    output_fields,
+                )[0]
+                prev = i
+
+        return results
+
     def _get_videos(self, video_ids, offset, limit, selected):
         query_hash = hashlib.sha256(
             (f"video:{repr(video_ids)}").encode("utf-8")
         ).hexdigest()
 
-        if query_hash in self.cache:
-            videos = self.cache[query_hash]
-        elif len(video_ids) == 0:
+        videos = self.cache.get(query_hash)
+        if videos is None and len(video_ids) == 0:
             videos = []
-        else:
-            video_ids_fitler = " || ".join(
-                [f'frame_id like "{x.strip()}#%"' for x in video_ids]
+        elif videos is None:
+            video_ids_fitler = self._videos_filter(video_ids)
+            videos = self._database.query(
+                video_ids_fitler, 0, 10000, ["frame_id"]
             )
-            videos = self._database.query(video_ids_fitler, 0, 10000)
             videos = sorted(videos, key=lambda x: x["frame_id"])
             videos = [{"entity": x} for x in videos]
-            self.cache[query_hash] = videos
+            self.cache.put(query_hash, videos)
 
         if selected:
             for i, video in enumerate(videos):
@@ -361,14 +608,14 @@ class Searcher(object):
         nprobe: int = 8,
         model: str = "clip",
     ):
-        record = self._database.get(id)
+        record = self._database.get_many([id], [model])
         if len(record) == 0:
             return {"results": [], "total": 0, "offset": 0}
 
         image_features = [record[0][model]]
 
         results = self._database.search(
-            image_features, "", offset, limit, nprobe, model
+            image_features, "", offset, limit, nprobe, model, ["frame_id"]
         )[0]
         res = {
             "results": results,
@@ -0,0 +1,77 @@
+import numpy as np
+
+from ..index import frame_position
+
+FRAME_BITS = 32
+
+
+def frame_keys(records):
+    video_ids = np.empty(len(records), dtype=np.int64)
+    frame_ids = np.empty(len(records), dtype=np.int64)
+    for i, record in enumerate(records):
+        video_ids[i], frame_ids[i] = frame_position(record["entity"])
+    return video_ids, frame_ids
+
+
+def encode_keys(video_ids, frame_ids):
+    # Pack (video, frame) into one sortable integer so a whole video is a
+    # contiguous range and frame windows can be found with searchsorted
+    return (video_ids << FRAME_BITS) | frame_ids
+
+
+def decode_keys(keys):
+    return keys >> FRAME_BITS, keys & ((1 << FRAME_BITS) - 1)
+
+
+def window_max(values, lo, hi):
+    # Maximum of values[lo[i]:hi[i]] for every non-empty window, answered
+    # from a sparse table so each query is two lookups
+    res = np.empty(len(lo), dtype=values.dtype)
+    if len(lo) == 0:
+        return res
+
+    table = [values]
+    width = 1
+    while width * 2 <= len(values):
+        prev = table[-1]
+        table.append(np.maximum(prev[:-width], prev[width:]))
+        width *= 2
+
+    levels = np.frexp(hi - lo)[1] - 1
+    for level in np.unique(levels):
+        mask = levels == level
+        step = 1 << int(level)
+        res[mask] = np.maximum(
+            table[level][lo[mask]], table[level][hi[mask] - step]
+        )
+    return res
+
+
+def temporal_join(keys, scores, temporal_k, max_interval):
+    # keys/scores hold one array per clause. A frame of clause i matches
+    # the best frame of clause i + 1 in the same video within
+    # (frame, frame + max_interval]. Returns indices into the first clause
+    # and the combined scores, ordered by score.
+    best_keys = keys[-1][:temporal_k]
+    best_scores = scores[-1][:temporal_k]
+    best_idx = np.arange(len(best_keys))
+
+    for cur_keys, cur_scores in zip(keys[-2::-1], scores[-2::-1]):
+        order = np.argsort(best_keys, kind="stable")
+        sorted_keys = best_keys[order]
+        sorted_scores = best_scores[order]
+
+        lo = np.searchsorted(sorted_keys, cur_keys, side="right")
+        hi = np.searchsorted(sorted_keys, cur_keys + max_interval, side="right")
+        valid = np.flatnonzero(hi > lo)
+
+        combined = cur_scores[valid] + window_max(
+            sorted_scores, lo[valid], hi[valid]
+        )
+        ranked = np.lexsort((cur_keys[valid], -combined))[:temporal_k]
+
+        best_idx = valid[ranked]
+        best_keys = cur_keys[best_idx]
+        best_scores = combined[ranked]
+
+    return best_idx, best_scores
@@ -0,0 +1,181 @@
+import os
+import json
+import threading
+
+import numpy as np
+
+FRAMES_SUFFIX = ".frames.json"
+
+
+class FeatureStore(object):
+    # Features of a video are packed in one shard per model:
+    #   features/<video_id>/<model>.npy          vectors, one row per frame
+    #   features/<video_id>/<model>.json         other values, one per frame
+    #   features/<video_id>/<model>.frames.json  frame ids in row order
+    # Vector shards are memory-mapped when read. Shards are replaced
+    # atomically, and a frame index that does not match its shard (a write
+    # interrupted between the two files) makes the shard unreadable rather
+    # than silently misaligned.
+    def __init__(self, features_dir):
+        self._features_dir = features_dir
+        self._lock = threading.Lock()
+
+    def video_ids(self):
+        return sorted(
+            [d.name for d in self._features_dir.glob("*") if d.is_dir()]
+        )
+
+    def models(self, video_id):
+        return sorted(
+            [
+                x.name[: -len(FRAMES_SUFFIX)]
+                for x in (self._features_dir / video_id).glob(
+                    f"*{FRAMES_SUFFIX}"
+                )
+            ]
+        )
+
+    def has(self, video_id, model):
+        return self._frames_path(video_id, model).exists()
+
+    def _frames_path(self, video_id, model):
+        return self._features_dir / video_id / f"{model}{FRAMES_SUFFIX}"
+
+    def _values_path(self, video_id, model, vector):
+        return (
+            self._features_dir
+            / video_id
+            / (f"{model}.npy" if vector else f"{model}.json")
+        )
+
+    def frame_ids(self, video_id, model):
+        path = self._frames_path(video_id, model)
+        if not path.exists():
+            return []
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def read(self, video_id, model, mmap=True):
+        # Returns (frame_ids, values) where values is an array of vectors or
+        # a list of json values
+        frame_ids = self.frame_ids(video_id, model)
+        if len(frame_ids) == 0:
+            return [], None
+
+        vector_path = self._values_path(video_id, model, True)
+        if vector_path.exists():
+            values = np.load(vector_path, mmap_mode="r" if mmap else None)
+        else:
+            with open(self._values_path(video_id, model, False), "r") as f:
+                values = json.load(f)
+        if len(values) != len(frame_ids):
+            raise RuntimeError(
+                f"{video_id}/{model}: shard does not match its frame index"
+            )
+        return frame_ids, values
+
+    def write(self, video_id, model, frame_ids, values, merge=True):
+        # Values of frames already in the shard are replaced, the others are
+        # kept unless merge is False. Rows are stored in frame order.
+        vector = isinstance(values, np.ndarray)
+        if merge and self.has(video_id, model):
+            old_ids, old_values = self.read(video_id, model, mmap=False)
+            new_ids = set(frame_ids)
+            kept = [i for i, x in enumerate(old_ids) if x not in new_ids]
+            frame_ids = [old_ids[i] for i in kept] + list(frame_ids)
+            if vector:
+                values = np.concatenate([np.asarray(old_values)[kept], values])
+            else:
+                values = [old_values[i] for i in kept] + list(values)
+
+        order = sorted(range(len(frame_ids)), key=lambda i: frame_ids[i])
+        frame_ids = [frame_ids[i] for i in order]
+        if vector:
+            values = values[order]
+        else:
+            values = [values[i] for i in order]
+
+        (self._features_dir / video_id).mkdir(parents=True, exist_ok=True)
+        values_path = self._values_path(video_id, model, vector)
+        other_path = self._values_path(video_id, model, not vector)
+        with self._lock:
+            tmp_path = values_path.with_name(f"{values_path.name}.tmp")
+            with open(tmp_path, "wb" if vector else "w") as f:
+                if vector:
+                    np.save(f, values)
+                else:
+                    json.dump(values, f)
+            os.replace(tmp_path, values_path)
+            if other_path.exists():
+                other_path.unlink()
+            self._write_json(self._frames_path(video_id, model), frame_ids)
+
+    def create(self, video_id, model, frame_ids, dim, dtype):
+        # Vector shard filled batch by batch through a memory map, so a
+        # video's features never have to be held in memory at once
+        (self._features_dir / video_id).mkdir(parents=True, exist_ok=True)
+        path = self._values_path(video_id, model, True)
+        return ShardWriter(
+            self,
+            video_id,
+            model,
+            frame_ids,
+            np.lib.format.open_memmap(
+                path.with_name(f"{path.name}.{threading.get_ident()}.tmp"),
+                mode="w+",
+                dtype=dtype,
+                shape=(len(frame_ids), dim),
+            ),
+        )
+
+    def _commit(self, writer, merge):
+        tmp_path = writer.values.filename
+        writer.values.flush()
+        values_path = self._values_path(writer.video_id, writer.model, True)
+        if (merge and self.has(writer.video_id, writer.model)) or (
+            writer.frame_ids != sorted(writer.frame_ids)
+        ):
+            self.write(
+                writer.video_id,
+                writer.model,
+                writer.frame_ids,
+                np.asarray(writer.values),
+                merge,
+            )
+            os.remove(tmp_path)
+            return
+
+        with self._lock:
+            os.replace(tmp_path, values_path)
+            other_path = self._values_path(writer.video_id, writer.model, False)
+            if other_path.exists():
+                other_path.unlink()
+            self._write_json(
+                self._frames_path(writer.video_id, writer.model),
+                writer.frame_ids,
+            )
+
+    def _write_json(self, path, data):
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+
+class ShardWriter(object):
+    def __init__(self, store, video_id, model, frame_ids, values):
+        self._store = store
+        self.video_id = video_id
+        self.model = model
+        self.frame_ids = list(frame_ids)
+        self.values = values
+
+    def commit(self, merge=True):
+        self._store._commit(self, merge)
+        self.values = None
+
+    def abort(self):
+        if self.values is not None:
+            tmp_path = self.values.filename
+            self.values = None
+            os.remove(tmp_path)
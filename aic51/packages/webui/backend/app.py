@@ -1,22 +1,45 @@
 import os
-import json
 import logging
 from pathlib import Path
 
-from fastapi import FastAPI, HTTPException, Request, Header, Response
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from ...search import Searcher
+from .executor import SearchExecutor, ExecutorOverloaded
+from .videos import VideoRegistry
+from .streaming import RangeFileResponse, resolve_path
+from .thumbnails import ThumbnailCache
 from ...analyse.features import CLIP
 from ....config import GlobalConfig
 
 WORK_DIR = Path(os.getenv("AIC51_WORK_DIR") or ".")
 logger = logging.getLogger(__name__)
 
-searcher = Searcher(GlobalConfig.get("webui", "database") or "milvus")
+searcher = Searcher(
+    GlobalConfig.get("webui", "collection") or "milvus",
+    WORK_DIR,
+    GlobalConfig.get("webui", "database") or "milvus",
+)
+
+videos = VideoRegistry(
+    WORK_DIR / "videos_info",
+    GlobalConfig.get("webui", "video_info_refresh") or 10,
+)
+thumbnail_config = GlobalConfig.get("webui", "thumbnails") or {}
+thumbnails = ThumbnailCache(
+    WORK_DIR / "keyframes",
+    WORK_DIR / (thumbnail_config.get("path") or ".thumbnails"),
+    thumbnail_config.get("widths") or (160, 320, 640),
+    thumbnail_config.get("max_bytes") or 1024 * 1024 * 1024,
+    thumbnail_config.get("quality") or 75,
+)
+CACHE_CONTROL = f'public, max-age={thumbnail_config.get("max_age") or 604800}'
+MAX_SPRITE_FRAMES = thumbnail_config.get("max_sprite_frames") or 200
+executor = SearchExecutor(**(GlobalConfig.get("webui", "executor") or {}))
 
 app = FastAPI()
 origins = [
@@ -31,6 +54,21 @@ app.add_middleware(
 )
 
 
+@app.on_event("shutdown")
+def shutdown():
+    executor.shutdown()
+    videos.close()
+
+
+async def run_search(func, *args):
+    try:
+        return await executor.run(func, *args)
+    except ExecutorOverloaded as e:
+        raise HTTPException(
+            status_code=503, detail=str(e), headers={"Retry-After": "1"}
+        )
+
+
 @app.get("/api/search")
 async def search(
     request: Request,
@@ -45,7 +83,8 @@ async def search(
     max_interval: int = 250,
     selected: str | None = None,
 ):
-    res = searcher.search(
+    res = await run_search(
+        searcher.search,
         q,
         "",
         offset,
@@ -66,12 +105,11 @@ async def search(
         frame_uri = (
             f"{request.base_url}api/files/keyframes/{video_id}/{frame_id}.jpg"
         )
+        thumbnail_uri = (
+            f"{request.base_url}api/thumbnails/{video_id}/{frame_id}.webp"
+        )
         video_uri = f"{request.base_url}api/stream/videos/{video_id}.mp4"
-        try:
-            with open(WORK_DIR / "videos_info" / f"{video_id}.json", "r") as f:
-                fps = json.load(f)["frame_rate"]
-        except:
-            fps = 25
+        fps = videos.get_fps(video_id)
 
         frames.append(
             dict(
@@ -79,6 +117,7 @@ async def search(
                 video_id=video_id,
                 frame_id=frame_id,
                 frame_uri=frame_uri,
+                thumbnail_uri=thumbnail_uri,
                 video_uri=video_uri,
                 fps=fps,
             )
@@ -114,7 +153,9 @@ async def similar(
     ocr_threshold: int = 40,
     max_interval: int = 250,
 ):
-    res = searcher.search_similar(id, offset, limit, nprobe, model)
+    res = await run_search(
+        searcher.search_similar, id, offset, limit, nprobe, model
+    )
     frames = []
     for record in res["results"]:
         data = record["entity"]
@@ -123,12 +164,11 @@ async def similar(
         frame_uri = (
             f"{request.base_url}api/files/keyframes/{video_id}/{frame_id}.jpg"
         )
+        thumbnail_uri = (
+            f"{request.base_url}api/thumbnails/{video_id}/{frame_id}.webp"
+        )
         video_uri = f"{request.base_url}api/stream/videos/{video_id}.mp4"
-        try:
-            with open(WORK_DIR / "videos_info" / f"{video_id}.json", "r") as f:
-                fps = json.load(f)["frame_rate"]
-        except:
-            fps = 25
+        fps = videos.get_fps(video_id)
 
         frames.append(
             dict(
@@ -136,6 +176,7 @@ async def similar(
                 video_id=video_id,
                 frame_id=frame_id,
                 frame_uri=frame_uri,
+                thumbnail_uri=thumbnail_uri,
                 video_uri=video_uri,
                 fps=fps,
             )
@@ -161,16 +202,12 @@ async def similar(
 @app.get("/api/frame_info")
 async def frame_info(request: Request, video_id: str, frame_id: str):
     id = f"{video_id}#{frame_id}"
-    record = searcher.get(id)
+    record = await run_search(searcher.get, id)
     frame_uri = (
         f"{request.base_url}api/files/keyframes/{video_id}/{frame_id}.jpg"
     )
     video_uri = f"{request.base_url}api/stream/videos/{video_id}.mp4"
-    try:
-        with open(WORK_DIR / "videos_info" / f"{video_id}.json", "r") as f:
-            fps = json.load(f)["frame_rate"]
-    except:
-        fps = 25
+    fps = videos.get_fps(video_id)
     return dict(
         id=id if len(record) > 0 else None,
         video_id=video_id,
@@ -182,29 +219,69 @@ async def frame_info(request: Request, video_id: str, frame_id: str):
 
 
 @app.get("/api/files/{file_path:path}")
-async def get_file(file_path):
-    return FileResponse(str(WORK_DIR / file_path))
-
-
-CHUNK_SIZE = 1024 * 1024
-
-
-@app.get("/api/stream/{file_path:path}")
-async def video_endpoint(file_path: str, range: str = Header(None)):
-    start, end = range.replace("bytes=", "").split("-")
-    start = int(start)
-    end = int(end) if end else start + CHUNK_SIZE
-    video_path = Path(file_path)
-    with open(video_path, "rb") as video:
-        video.seek(start)
-        data = video.read(end - start)
-        filesize = video_path.stat().st_size
-        headers = {
-            "Content-Range": f"bytes {str(start)}-{str(min(end, filesize-1))}/{str(filesize)}",
-            "Accept-Ranges": "bytes",
-        }
-    return Response(
-        data, status_code=206, headers=headers, media_type="video/mp4"
+async def get_file(request: Request, file_path: str):
+    response = RangeFileResponse(
+        resolve_path(WORK_DIR, file_path), request.headers, request.method
+    )
+    response.headers["cache-control"] = "public, no-cache"
+    return response
+
+
+@app.get("/api/thumbnails/sprite")
+def get_thumbnail_sprite(
+    request: Request, ids: str, width: int = 160, columns: int = 10
+):
+    ids = ids.split(",")
+    # Every frame is rendered and pasted into one image on this thread
+    if len(ids) > MAX_SPRITE_FRAMES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_SPRITE_FRAMES} frames fit in a sprite",
+        )
+    frames = []
+    for id in ids:
+        video_id, _, frame_id = id.partition("#")
+        if len(frame_id) == 0:
+            raise HTTPException(status_code=400, detail=f"{id}: invalid id")
+        frames.append((video_id, frame_id))
+    if len(frames) == 0 or columns <= 0:
+        raise HTTPException(status_code=400, detail="No frames requested")
+    try:
+        path, width, height = thumbnails.get_sprite(
+            frames, width, min(columns, len(frames))
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Keyframe not found")
+
+    response = RangeFileResponse(path, request.headers, request.method)
+    response.headers["cache-control"] = CACHE_CONTROL
+    response.headers["x-sprite-tile"] = f"{width}x{height}"
+    response.headers["x-sprite-columns"] = str(min(columns, len(frames)))
+    return response
+
+
+@app.get("/api/thumbnails/{video_id}/{frame_id}.{fmt}")
+def get_thumbnail(
+    request: Request, video_id: str, frame_id: str, fmt: str, width: int = 320
+):
+    try:
+        path = thumbnails.get(video_id, frame_id, width, fmt)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Keyframe not found")
+
+    response = RangeFileResponse(path, request.headers, request.method)
+    response.headers["cache-control"] = CACHE_CONTROL
+    return response
+
+
+@app.api_route("/api/stream/{file_path:path}", methods=["GET", "HEAD"])
+async def video_endpoint(request: Request, file_path: str):
+    return RangeFileResponse(
+        resolve_path(WORK_DIR, file_path), request.headers, request.method
     )
 
 
@@ -213,6 +290,21 @@ async def models():
     return {"models": searcher.get_models()}
 
 
+@app.get("/api/cache")
+async def cache_stats():
+    return searcher.get_cache_stats()
+
+
+@app.get("/api/thumbnails")
+async def thumbnail_stats():
+    return thumbnails.stats()
+
+
+@app.get("/api/executor")
+async def executor_stats():
+    return executor.stats()
+
+
 WEB_DIR = WORK_DIR / ".web"
 if WEB_DIR.exists():
     app.mount(
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ExecutorOverloaded(Exception):
+    pass
+
+
+class SearchExecutor(object):
+    # Runs blocking search calls on a bounded thread pool so they never block
+    # the event loop. Calls beyond max_workers wait in the queue, and calls
+    # beyond max_workers + max_queue are rejected instead of piling up.
+    def __init__(self, max_workers=4, max_queue=32):
+        self._logger = logging.getLogger(
+            f'{".".join(__name__.split(".")[:-1])}.{self.__class__.__name__}'
+        )
+        self._max_workers = max_workers
+        self._max_queue = max_queue
+        self._executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="search"
+        )
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._active = 0
+        self._max_depth = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._wait_time = 0.0
+        self._run_time = 0.0
+
+    async def run(self, func, *args):
+        with self._lock:
+            if self._pending >= self._max_workers + self._max_queue:
+                self.rejected += 1
+                self._logger.warning("Search queue is full, rejecting call")
+                raise ExecutorOverloaded(
+                    f"{self._pending} search calls are already pending"
+                )
+            self._pending += 1
+            self._max_depth = max(self._max_depth, self.queue_depth)
+
+        try:
+            future = self._executor.submit(
+                self._call, time.perf_counter(), func, args
+            )
+        except Exception:
+            self._release()
+            raise
+        # A cancelled request stops waiting, but a search already running
+        # keeps its slot until the thread finishes it
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def _release(self, future=None):
+        with self._lock:
+            self._pending -= 1
+
+    def _call(self, submitted, func, args):
+        st = time.perf_counter()
+        with self._lock:
+            self._active += 1
+            self._wait_time += st - submitted
+        try:
+            res = func(*args)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._run_time += time.perf_counter() - st
+
+        with self._lock:
+            self.completed += 1
+        return res
+
+    @property
+    def queue_depth(self):
+        return max(self._pending - self._active, 0)
+
+    def stats(self):
+        with self._lock:
+            finished = self.completed + self.failed
+            return {
+                "max_workers": self._max_workers,
+                "max_queue": self._max_queue,
+                "active": self._active,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self._max_depth,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "avg_wait_ms": (
+                    self._wait_time / finished * 1000 if finished else 0.0
+                ),
+                "avg_run_ms": (
+                    self._run_time / finished * 1000 if finished else 0.0
+                ),
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
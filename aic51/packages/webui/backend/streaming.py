@@ -0,0 +1,221 @@
+import os
+import mmap
+import secrets
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import HTTPException
+from starlette.responses import Response
+
+CHUNK_SIZE = 256 * 1024
+
+
+def resolve_path(root, file_path):
+    root = root.resolve()
+    path = (root / file_path).resolve()
+    if not path.is_relative_to(root) or not path.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
+    return path
+
+
+def parse_range(header, size):
+    # Returns the list of (start, end) byte ranges, end inclusive, or None
+    # when the header should be ignored. Raises ValueError when no range
+    # can be satisfied.
+    unit, _, ranges = header.partition("=")
+    if unit.strip().lower() != "bytes" or len(ranges.strip()) == 0:
+        return None
+
+    res = []
+    for spec in ranges.split(","):
+        start, sep, end = spec.strip().partition("-")
+        if sep != "-":
+            return None
+        try:
+            if len(start) == 0:
+                # Suffix range: the last n bytes
+                length = int(end)
+                if length <= 0:
+                    continue
+                res.append((max(size - length, 0), size - 1))
+                continue
+            start = int(start)
+            end = int(end) if len(end) > 0 else size - 1
+        except ValueError:
+            return None
+        if start >= size:
+            continue
+        if start > end:
+            return None
+        res.append((start, min(end, size - 1)))
+
+    if len(res) == 0:
+        raise ValueError("Range not satisfiable")
+    return _merge_ranges(res)
+
+
+def _merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class RangeFileResponse(Response):
+    # Serves a file with single and multi-part byte ranges. When the server
+    # implements the ASGI zero-copy send extension the kernel copies the
+    # bytes with sendfile, otherwise they are sent in bounded chunks sliced
+    # from a memory map, never reading a whole range into memory.
+    def __init__(self, path, headers, method="GET", media_type=None):
+        self._path = path
+        self._method = method
+        stat = os.stat(path)
+        self._size = stat.st_size
+        self.etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self._mtime = int(stat.st_mtime)
+        self._media_type = (
+            media_type
+            or mimetypes.guess_type(path.name)[0]
+            or "application/octet-stream"
+        )
+
+        super(RangeFileResponse, self).__init__(
+            status_code=200, media_type=self._media_type
+        )
+        self._ranges = None
+        self._parts = []
+        self._plan(headers)
+
+    def _plan(self, request_headers):
+        self.headers["accept-ranges"] = "bytes"
+        self.headers["etag"] = self.etag
+        self.headers["last-modified"] = self.last_modified
+
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None and self.etag in [
+            x.strip() for x in if_none_match.split(",")
+        ]:
+            self.status_code = 304
+            self._set_length(0)
+            return
+
+        range_header = request_headers.get("range")
+        if range_header is not None and self._if_range_matches(
+            request_headers.get("if-range")
+        ):
+            try:
+                self._ranges = parse_range(range_header, self._size)
+            except ValueError:
+                self.status_code = 416
+                self.headers["content-range"] = f"bytes */{self._size}"
+                self._set_length(0)
+                return
+
+        if self._ranges is None:
+            self._parts = [(None, 0, self._size)]
+            self._set_length(self._size)
+        elif len(self._ranges) == 1:
+            start, end = self._ranges[0]
+            self.status_code = 206
+            self.headers["content-range"] = f"bytes {start}-{end}/{self._size}"
+            self._parts = [(None, start, end - start + 1)]
+            self._set_length(end - start + 1)
+        else:
+            self.status_code = 206
+            boundary = secrets.token_hex(16)
+            self.headers["content-type"] = (
+                f"multipart/byteranges; boundary={boundary}"
+            )
+            length = 0
+            for start, end in self._ranges:
+                part_header = (
+                    f"--{boundary}\r\n"
+                    f"Content-Type: {self._media_type}\r\n"
+                    f"Content-Range: bytes {start}-{end}/{self._size}\r\n\r\n"
+                ).encode("latin-1")
+                self._parts.append((part_header, start, end - start + 1))
+                length += len(part_header) + end - start + 1 + 2
+            self._trailer = f"--{boundary}--\r\n".encode("latin-1")
+            self._set_length(length + len(self._trailer))
+
+    def _if_range_matches(self, if_range):
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            # Weak validators never match If-Range
+            return if_range == self.etag
+        try:
+            return int(parsedate_to_datetime(if_range).timestamp()) == (
+                self._mtime
+            )
+        except (TypeError, ValueError):
+            return False
+
+    def _set_length(self, length):
+        self.headers["content-length"] = str(length)
+
+    async def __call__(self, scope, receive, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if self._method == "HEAD" or self.status_code in [304, 416]:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        multipart = self._ranges is not None and len(self._ranges) > 1
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        with open(self._path, "rb") as f:
+            if zerocopy:
+                await self._send_zerocopy(f, send, multipart)
+            else:
+                await self._send_mmap(f, send, multipart)
+
+    async def _send_zerocopy(self, f, send, multipart):
+        for part_header, start, length in self._parts:
+            if part_header is not None:
+                await self._send_body(send, part_header)
+            await send(
+                {
+                    "type": "http.response.zerocopysend",
+                    "file": f.fileno(),
+                    "offset": start,
+                    "count": length,
+                    "more_body": True,
+                }
+            )
+            if multipart:
+                await self._send_body(send, b"\r\n")
+        await self._send_body(
+            send, self._trailer if multipart else b"", more_body=False
+        )
+
+    async def _send_mmap(self, f, send, multipart):
+        if self._size == 0:
+            await self._send_body(send, b"", more_body=False)
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for part_header, start, length in self._parts:
+                if part_header is not None:
+                    await self._send_body(send, part_header)
+                for offset in range(start, start + length, CHUNK_SIZE):
+                    end = min(offset + CHUNK_SIZE, start + length)
+                    await self._send_body(send, mm[offset:end])
+                if multipart:
+                    await self._send_body(send, b"\r\n")
+            await self._send_body(
+                send, self._trailer if multipart else b"", more_body=False
+            )
+
+    async def _send_body(self, send, body, more_body=True):
+        await send(
+            {"type": "http.response.body", "body": body, "more_body": more_body}
+        )
@@ -0,0 +1,184 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from math import ceil
+
+from PIL import Image
+
+FORMATS = {"webp": "WEBP", "jpg": "JPEG"}
+
+
+class ThumbnailCache(object):
+    # Downscaled keyframes generated on first request and kept in cache_dir.
+    # The directory is bounded by max_bytes and evicts the least recently
+    # served files first. A thumbnail older than its keyframe is rebuilt.
+    # Files served in the last GRACE_SECONDS are never evicted, as their
+    # path may be handed to a response that has not opened it yet; the
+    # directory can briefly exceed max_bytes instead.
+    GRACE_SECONDS = 10
+
+    def __init__(
+        self,
+        keyframes_dir,
+        cache_dir,
+        widths=(160, 320, 640),
+        max_bytes=1024 * 1024 * 1024,
+        quality=75,
+    ):
+        self._keyframes_dir = keyframes_dir
+        self._cache_dir = cache_dir
+        self.widths = sorted(widths)
+        self._max_bytes = max_bytes
+        self._quality = quality
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load()
+
+    def _load(self):
+        files = []
+        for root, _, names in os.walk(self._cache_dir):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                files.append((stat.st_atime, os.path.join(root, name), stat))
+        for _, path, stat in sorted(files):
+            self._entries[path] = (stat.st_size, 0)
+            self._total_bytes += stat.st_size
+
+    def _touch(self, path, size=None, hit=True):
+        # Raises FileNotFoundError for a hit whose file has just been evicted
+        path = str(path)
+        now = time.monotonic()
+        with self._lock:
+            if size is None:
+                size = os.stat(path).st_size
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if path in self._entries:
+                self._total_bytes -= self._entries[path][0]
+            self._entries[path] = (size, now)
+            self._entries.move_to_end(path)
+            self._total_bytes += size
+
+            while (
+                self._total_bytes > self._max_bytes and len(self._entries) > 1
+            ):
+                old_path, (old_size, touched) = next(
+                    iter(self._entries.items())
+                )
+                if now - touched < self.GRACE_SECONDS:
+                    break
+                del self._entries[old_path]
+                self._total_bytes -= old_size
+                self.evictions += 1
+                try:
+                    os.remove(old_path)
+                except FileNotFoundError:
+                    pass
+
+    def snap_width(self, width):
+        # Only a few sizes are generated so they are shared between clients
+        return next((x for x in self.widths if x >= width), self.widths[-1])
+
+    def _write(self, path, image, fmt):
+        # A stale entry of the path is dropped first, so it is not evicted
+        # between the rewrite and the touch that follows
+        with self._lock:
+            if str(path) in self._entries:
+                self._total_bytes -= self._entries.pop(str(path))[0]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        image.save(tmp_path, FORMATS[fmt], quality=self._quality)
+        os.replace(tmp_path, path)
+        return os.stat(path).st_size
+
+    def _render(self, source, width):
+        with Image.open(source) as image:
+            image.draft("RGB", (width, width))
+            image = image.convert("RGB")
+            image.thumbnail((width, width * image.height // image.width))
+        return image
+
+    def get(self, video_id, frame_id, width, fmt="webp"):
+        if fmt not in FORMATS:
+            raise ValueError(f"{fmt}: thumbnail format is not available")
+        for name in [video_id, frame_id]:
+            if name in ["", ".", ".."] or "/" in name or os.sep in name:
+                raise ValueError(f"{name}: invalid frame")
+        source = self._keyframes_dir / video_id / f"{frame_id}.jpg"
+        width = self.snap_width(width)
+        path = self._cache_dir / str(width) / video_id / f"{frame_id}.{fmt}"
+
+        try:
+            fresh = os.stat(path).st_mtime_ns >= os.stat(source).st_mtime_ns
+        except FileNotFoundError:
+            if not source.exists():
+                raise
+            fresh = False
+
+        if fresh:
+            try:
+                self._touch(path)
+                return path
+            except FileNotFoundError:
+                pass
+        self._touch(
+            path, self._write(path, self._render(source, width), fmt), hit=False
+        )
+        return path
+
+    def get_sprite(self, frames, width, columns, fmt="jpg"):
+        # One image holding the thumbnails of a result page in row-major
+        # order, so a grid costs a single request
+        width = self.snap_width(width)
+        paths = [self.get(v, f, width, fmt) for v, f in frames]
+        key = hashlib.sha256(
+            repr(
+                [(str(x), os.stat(x).st_mtime_ns) for x in paths]
+                + [width, columns]
+            ).encode("utf-8")
+        ).hexdigest()
+        path = self._cache_dir / "sprites" / f"{key}.{fmt}"
+
+        sizes = []
+        for x in paths:
+            with Image.open(x) as image:
+                sizes.append(image.size)
+        height = max([h for _, h in sizes])
+
+        try:
+            self._touch(path)
+            return path, width, height
+        except FileNotFoundError:
+            pass
+
+        rows = ceil(len(paths) / columns)
+        sprite = Image.new("RGB", (width * columns, height * rows))
+        for i, x in enumerate(paths):
+            with Image.open(x) as image:
+                sprite.paste(
+                    image, ((i % columns) * width, (i // columns) * height)
+                )
+        self._touch(path, self._write(path, sprite, fmt), hit=False)
+        return path, width, height
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self._max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
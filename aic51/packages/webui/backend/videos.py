@@ -0,0 +1,83 @@
+import os
+import json
+import logging
+import threading
+
+DEFAULT_FPS = 25
+
+
+class VideoRegistry(object):
+    # In-memory copy of videos_info/*.json. A background thread re-scans the
+    # directory every refresh_interval seconds and only reads files whose
+    # mtime changed. Lookups are plain dict reads, so async handlers never
+    # touch files.
+    def __init__(self, info_dir, refresh_interval=10):
+        self._logger = logging.getLogger(
+            f'{".".join(__name__.split(".")[:-1])}.{self.__class__.__name__}'
+        )
+        self._info_dir = info_dir
+        self._refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._videos = {}
+        self._mtimes = {}
+        self.refresh()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self._refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                self._logger.warning(f"Refreshing videos info failed: {e}")
+
+    def refresh(self):
+        with self._lock:
+            try:
+                entries = list(os.scandir(self._info_dir))
+            except FileNotFoundError:
+                entries = []
+
+            videos = {}
+            mtimes = {}
+            for entry in entries:
+                if not entry.name.endswith(".json"):
+                    continue
+                video_id = entry.name[: -len(".json")]
+                mtime = entry.stat().st_mtime_ns
+                if self._mtimes.get(video_id) == mtime:
+                    videos[video_id] = self._videos[video_id]
+                    mtimes[video_id] = mtime
+                    continue
+                try:
+                    with open(entry.path, "r") as f:
+                        videos[video_id] = json.load(f)
+                    mtimes[video_id] = mtime
+                except (OSError, ValueError) as e:
+                    # The previous version stays until the file reads again
+                    self._logger.warning(f"{entry.name}: {e}")
+                    if video_id in self._videos:
+                        videos[video_id] = self._videos[video_id]
+                        mtimes[video_id] = self._mtimes[video_id]
+
+            # Swapped whole, so readers never see a half refreshed dict
+            self._videos = videos
+            self._mtimes = mtimes
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def get(self, video_id):
+        return self._videos.get(video_id)
+
+    def get_fps(self, video_id):
+        info = self.get(video_id)
+        if info is None or not info.get("frame_rate"):
+            return DEFAULT_FPS
+        return info["frame_rate"]
+
+    def __len__(self):
+        return len(self._videos)
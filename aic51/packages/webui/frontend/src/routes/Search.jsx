@@ -320,7 +320,7 @@ export default function Search() {
                 key={frame.id}
                 video_id={frame.video_id}
                 frame_id={frame.frame_id}
-                thumbnail={frame.frame_uri}
+                thumbnail={frame.thumbnail_uri ?? frame.frame_uri}
                 onPlay={() => {
                   handleOnPlay(frame);
                 }}